@@ -0,0 +1,86 @@
+# coding: utf-8
+# Memory benchmark of the events and intervals of the serializer for RecVNC
+#
+# Measures a synthetic long session with the layouts of serializer.py
+# (__slots__ and numpy columns) and the dict-based layout used before them.
+#
+#     python src/benchmark_memory.py [--events N] [--intervals N]
+#
+
+import argparse
+import tracemalloc
+
+from serializer import PointerEvent, EventColumns, Interval
+
+
+# the previous layout: attributes in __dict__ and args as a list
+class DictEvent(object):
+
+    def __init__(self, time_abs, time_origin_abs, args):
+
+        self.time_abs = time_abs
+        self.time_origin_abs = time_origin_abs
+        self.time_rel = time_abs - time_origin_abs
+        self.args = args
+
+
+class DictInterval(object):
+
+    def __init__(self, ge, lt):
+
+        self.ge = ge
+        self.lt = lt
+        self.image = None
+        self.xy = None
+        self.key_event = None
+        self.button_event = None
+        self.cursor_event = None
+        self.control_events = None
+
+
+def measure(make):
+    """Returns the bytes allocated by make() and kept by the objects it returns"""
+
+    tracemalloc.start()
+    objects = make()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    return current
+
+
+def benchmark_memory(num_events=100000, num_intervals=3600):
+    """Measures pointer events and intervals.
+    Each layout holds the same data in the same container,
+    so the difference comes from the layout of the objects."""
+
+    times = [1000.0 + 0.01 * i for i in range(num_events)]
+    boundaries = [0.1 * i for i in range(num_intervals + 1)]
+
+    results = {
+        'events_dict': measure(lambda: [DictEvent(t, 1000.0, [i % 800, i % 600, 0]) for i, t in enumerate(times)]),
+        'events_slots': measure(lambda: [PointerEvent(t, 1000.0, [i % 800, i % 600, 0]) for i, t in enumerate(times)]),
+        'events_columns': measure(lambda: EventColumns(
+            PointerEvent, times, 1000.0, [[i % 800, i % 600, 0] for i in range(num_events)])),
+        'intervals_dict': measure(lambda: [DictInterval(ge, lt) for ge, lt in zip(boundaries, boundaries[1:])]),
+        'intervals_slots': measure(lambda: [Interval(ge, lt) for ge, lt in zip(boundaries, boundaries[1:])]),
+    }
+
+    print(f'pointer events: {num_events}')
+    for k in ('events_dict', 'events_slots', 'events_columns'):
+        print(f'    {k}: {results[k] / 2**20:.1f} MiB ({results[k] / num_events:.0f} B/event)')
+    print(f'intervals: {num_intervals}')
+    for k in ('intervals_dict', 'intervals_slots'):
+        print(f'    {k}: {results[k] / 2**10:.1f} KiB ({results[k] / num_intervals:.0f} B/interval)')
+
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Measures the memory of events and intervals of a synthetic session.')
+    parser.add_argument('--events', type=int, default=100000, help='number of pointer events')
+    parser.add_argument('--intervals', type=int, default=3600, help='number of intervals')
+    args = parser.parse_args()
+
+    benchmark_memory(args.events, args.intervals)
@@ -0,0 +1,476 @@
+# coding: utf-8
+# Capture utilities for RecVNC
+#
+# The recording thread only grabs raw frames.
+# Encoding and writing them are done by the classes in this file.
+#
+
+import time
+import zlib
+import queue
+import threading
+import collections
+import multiprocessing
+from multiprocessing import shared_memory
+
+import PIL.Image
+
+
+class FrameJob(object):
+    """A raw frame that waits for encoding"""
+
+    def __init__(self, path, size, data, rawmode='BGRX'):
+
+        self.path = path
+        self.size = size
+        self.data = data
+        self.rawmode = rawmode
+
+    def run(self):
+
+        image = PIL.Image.frombytes(
+            'RGB', self.size, self.data, 'raw', self.rawmode, self.size[0] * 4, 1)
+        image.save(self.path)
+
+
+class MarkerJob(object):
+    """A marker file that tells the frame is the same as a previous frame.
+    The file contains the name of the referred image file."""
+    
+    def __init__(self, path, ref_name):
+        
+        self.path = path
+        self.ref_name = ref_name
+    
+    def run(self):
+        
+        with open(self.path, 'w') as f:
+            f.write(self.ref_name)
+
+
+class FrameEncoderPool(object):
+    """Encodes raw frames into image files with worker threads.
+    The capture thread pushes jobs with submit() and never waits for encoding.
+    A job is dropped (and counted) when the queue is full."""
+
+    def __init__(self, num_workers=2, max_queue=16):
+
+        self.num_workers = max(1, num_workers)
+        self.max_queue = max(1, max_queue)
+        self.queue = queue.Queue(self.max_queue)
+
+        # counters
+        self.lock = threading.Lock()
+        self.num_submitted = 0
+        self.num_encoded = 0
+        self.num_dropped = 0
+        self.num_failed = 0
+        self.max_queue_depth = 0
+
+        self.workers = []
+        for _ in range(self.num_workers):
+            worker = threading.Thread(target=self.work, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, job):
+        """Enqueues a job without blocking. Returns False if the job was dropped."""
+
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            with self.lock:
+                self.num_dropped += 1
+            return False
+
+        with self.lock:
+            self.num_submitted += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return True
+
+    def work(self):
+
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            try:
+                job.run()
+                with self.lock:
+                    self.num_encoded += 1
+            except Exception as e:
+                print('frame encoding failed:', e)
+                with self.lock:
+                    self.num_failed += 1
+
+    def close(self):
+        """Waits until the queued jobs are finished and stops the workers"""
+
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def get_stats(self):
+
+        with self.lock:
+            return {
+                'num_workers': self.num_workers,
+                'max_queue': self.max_queue,
+                'queue_depth': self.queue.qsize(),
+                'max_queue_depth': self.max_queue_depth,
+                'submitted': self.num_submitted,
+                'encoded': self.num_encoded,
+                'dropped': self.num_dropped,
+                'failed': self.num_failed,
+            }
+
+
+class SharedFrameRing(object):
+    """A ring of preallocated frame slots in shared memory (/dev/shm).
+    The capture thread copies a raw frame into a free slot 
+    and encoder processes read the slot without pickling the frame."""
+    
+    def __init__(self, num_slots, slot_size, name=None):
+        
+        self.num_slots = num_slots
+        self.slot_size = slot_size
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=num_slots * slot_size)
+            self.owner = True
+        else:
+            # Encoder processes share the resource tracker of the owner,
+            # so the memory is unlinked once by the owner.
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+    
+    @property
+    def name(self):
+        
+        return self.shm.name
+    
+    def write(self, slot, data):
+        
+        offset = slot * self.slot_size
+        self.shm.buf[offset:offset+len(data)] = data
+    
+    def view(self, slot, nbytes):
+        """Returns a memoryview of a slot. Release it before close()."""
+        
+        offset = slot * self.slot_size
+        return self.shm.buf[offset:offset+nbytes]
+    
+    def close(self):
+        
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def run_encoder_process(ring_name, num_slots, slot_size, job_queue, result_queue):
+    """Main loop of an encoder process of ProcessFrameEncoderPool"""
+    
+    ring = SharedFrameRing(num_slots, slot_size, name=ring_name)
+    try:
+        while True:
+            item = job_queue.get()
+            if item is None:
+                break
+            
+            slot = None
+            ok = True
+            try:
+                if item[0] == 'frame':
+                    _, slot, size, nbytes, rawmode, path = item
+                    buf = ring.view(slot, nbytes)
+                    try:
+                        image = PIL.Image.frombuffer(
+                            'RGB', size, buf, 'raw', rawmode, size[0] * 4, 1)
+                        image.save(path)
+                    finally:
+                        buf.release()
+                else:
+                    item[1].run()
+            except Exception as e:
+                print('frame encoding failed:', e)
+                ok = False
+            result_queue.put((slot, ok))
+    finally:
+        ring.close()
+
+
+class ProcessFrameEncoderPool(object):
+    """Encodes raw frames in encoder processes to scale encoding past the GIL.
+    Frames are passed through SharedFrameRing. A frame is dropped (and counted)
+    when no slot is free. The ring and the processes are made at the first frame
+    because the frame size is unknown before. They are made again for a larger frame
+    (e.g. after a desktop resize of the VNC server) once the queued frames are encoded."""
+    
+    def __init__(self, num_workers=2, max_queue=16):
+        
+        self.num_workers = max(1, num_workers)
+        self.max_queue = max(1, max_queue)
+        
+        self.context = multiprocessing.get_context('spawn')
+        self.job_queue = self.context.Queue()
+        self.result_queue = self.context.Queue()
+        self.ring = None
+        self.free_slots = collections.deque()
+        self.processes = []
+        self.collector = None
+        
+        # counters
+        self.lock = threading.Lock()
+        self.num_submitted = 0
+        self.num_encoded = 0
+        self.num_dropped = 0
+        self.num_failed = 0
+        self.max_queue_depth = 0
+    
+    def start(self, slot_size):
+        
+        self.ring = SharedFrameRing(self.max_queue, slot_size)
+        self.free_slots.clear()
+        self.free_slots.extend(range(self.max_queue))
+        
+        for _ in range(self.num_workers):
+            process = self.context.Process(
+                target=run_encoder_process,
+                args=(self.ring.name, self.max_queue, slot_size, self.job_queue, self.result_queue),
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+        
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+    
+    def submit(self, job):
+        """Enqueues a job without blocking. Returns False if the job was dropped."""
+        
+        if isinstance(job, FrameJob):
+            if self.ring is None:
+                self.start(len(job.data))
+            elif len(job.data) > self.ring.slot_size:
+                print(f'frame encoder processes are restarted for frames of {len(job.data)} bytes '
+                      f'(slots of {self.ring.slot_size} bytes)')
+                self.close()
+                self.start(len(job.data))
+            
+            try:
+                slot = self.free_slots.popleft()
+            except IndexError:
+                slot = None
+            if slot is None:
+                with self.lock:
+                    self.num_dropped += 1
+                return False
+            
+            self.ring.write(slot, job.data)
+            self.job_queue.put(('frame', slot, job.size, len(job.data), job.rawmode, job.path))
+        else:
+            if self.ring is None:
+                # processes are not running before the first frame
+                job.run()
+                with self.lock:
+                    self.num_submitted += 1
+                    self.num_encoded += 1
+                return True
+            self.job_queue.put(('job', job))
+        
+        with self.lock:
+            self.num_submitted += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.max_queue - len(self.free_slots))
+        return True
+    
+    def collect(self):
+        
+        while True:
+            result = self.result_queue.get()
+            if result is None:
+                break
+            slot, ok = result
+            if slot is not None:
+                self.free_slots.append(slot)
+            with self.lock:
+                if ok:
+                    self.num_encoded += 1
+                else:
+                    self.num_failed += 1
+    
+    def close(self):
+        """Waits until the queued jobs are finished and stops the processes"""
+        
+        for _ in self.processes:
+            self.job_queue.put(None)
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        
+        if self.collector is not None:
+            self.result_queue.put(None)
+            self.collector.join()
+            self.collector = None
+        
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+    
+    def get_stats(self):
+        
+        with self.lock:
+            return {
+                'num_workers': self.num_workers,
+                'max_queue': self.max_queue,
+                'queue_depth': self.max_queue - len(self.free_slots) if self.ring else 0,
+                'max_queue_depth': self.max_queue_depth,
+                'submitted': self.num_submitted,
+                'encoded': self.num_encoded,
+                'dropped': self.num_dropped,
+                'failed': self.num_failed,
+            }
+
+
+class CaptureScheduler(object):
+    """Gives capture deadlines on time.monotonic().
+    The n-th deadline is start + n * interval, so jitter does not pile up.
+    The policy decides what to do with deadlines missed by a slow capture.
+        skip: drop the missed deadlines and wait for the next one.
+        burst: capture the missed deadlines back to back until catching up.
+    """
+    
+    policies = ('skip', 'burst')
+    
+    def __init__(self, interval, policy='skip', start=None):
+        
+        assert policy in self.policies, f'unknown catch-up policy: {policy}'
+        
+        self.interval = interval
+        self.policy = policy
+        self.start = time.monotonic() if start is None else start
+        self.index = 0
+        self.num_skipped = 0
+        self.num_late = 0
+    
+    def get_deadline(self, index):
+        
+        return self.start + index * self.interval
+    
+    def wait(self, stop_event):
+        """Waits for the next deadline.
+        Returns (index, deadline) of the frame or None if stop_event is set."""
+        
+        deadline = self.get_deadline(self.index)
+        delay = time.monotonic() - deadline
+        
+        if delay >= self.interval:
+            self.num_late += 1
+            if self.policy == 'skip':
+                skipped = int(delay // self.interval)
+                self.num_skipped += skipped
+                self.index += skipped
+                deadline = self.get_deadline(self.index)
+        
+        if stop_event.wait(max(0, deadline - time.monotonic())):
+            return None
+        
+        index = self.index
+        self.index += 1
+        return index, deadline
+    
+    def get_stats(self):
+        
+        return {
+            'policy': self.policy,
+            'scheduled': self.index,
+            'late': self.num_late,
+            'skipped': self.num_skipped,
+        }
+
+
+class TileChecksum(object):
+    """Detects changes between raw frames with checksums of tiles.
+    A tile is a band of tile_rows rows, which is a contiguous slice of the buffer. 
+    So checksums are computed without copying the buffer."""
+    
+    def __init__(self, tile_rows=16):
+        
+        self.tile_rows = tile_rows
+        self.last_size = None
+        self.last_checksums = None
+    
+    def compute(self, size, data, bytes_per_pixel=4):
+        
+        step = size[0] * bytes_per_pixel * self.tile_rows
+        view = memoryview(data)
+        return [zlib.crc32(view[i:i+step]) for i in range(0, len(view), step)]
+    
+    def update(self, size, data):
+        """Returns the list of changed tile ids compared with the last frame.
+        All tiles are regarded as changed for the first frame."""
+        
+        checksums = self.compute(size, data)
+        if size != self.last_size:
+            changed = list(range(len(checksums)))
+        else:
+            changed = [i for i, (c, lc) in enumerate(zip(checksums, self.last_checksums)) if c != lc]
+        
+        self.last_size = size
+        self.last_checksums = checksums
+        return changed
+    
+    def reset(self):
+        
+        self.last_size = None
+        self.last_checksums = None
+
+
+class FrameStream(object):
+    """Passes frames from an event-driven frame source (the VNC proxy) to a recording thread.
+    The source calls push() when an update of the screen is committed.
+    Frames are queued only while a recording opens the stream, 
+    so push() never blocks the caller.
+    The proxy keeps a framebuffer only for the VNC sessions connected while enabled
+    (capture_source=vnc); the other sessions are proxied without it."""
+    
+    def __init__(self):
+        
+        self.enabled = False
+        self.queue = None
+        self.min_interval = 0.0
+        self.snapshot_func = None
+    
+    @property
+    def active(self):
+        
+        return self.queue is not None
+    
+    def set_source(self, snapshot_func):
+        """snapshot_func returns the current frame in the same form as push() arguments,
+        or None if no frame is available"""
+        
+        self.snapshot_func = snapshot_func
+    
+    def open(self, min_interval=0.0):
+        
+        self.min_interval = min_interval
+        self.queue = queue.SimpleQueue()
+        return self.queue
+    
+    def close(self):
+        
+        self.queue = None
+    
+    def push(self, t_wall, t_mono, size, rows, rawmode):
+        """rows are the rows of the frame, which are not modified after this"""
+        
+        q = self.queue
+        if q is not None:
+            q.put((t_wall, t_mono, size, rows, rawmode))
+    
+    def snapshot(self):
+        
+        if self.snapshot_func is None:
+            return None
+        return self.snapshot_func()
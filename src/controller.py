@@ -15,8 +15,10 @@ import base64
 import time
 import datetime
 import subprocess
+import queue
 import asyncio
 import threading
+import collections
 import numpy as np
 
 import PIL.Image
@@ -31,6 +33,10 @@ from vnc_proxy import CustomVNCLoggingServerFactory, CustomVNCLoggingServerProxy
 from twisted.internet import reactor
 
 import serializer
+import eventlog
+import record_index
+from capture import FrameJob, MarkerJob, FrameEncoderPool, ProcessFrameEncoderPool
+from capture import CaptureScheduler, TileChecksum, FrameStream
 
 DEFAULT_DISPLAY = ':1.0'
 os.environ['DISPLAY'] = DEFAULT_DISPLAY
@@ -70,12 +76,30 @@ class ControllerConfig(object):
         do_recording = True,
         screenshot_interval = 0.1,
         script_rule_name = 'script_rule.js',
-        task_sequence_name = 'default_tasks.yml'
+        task_sequence_name = 'default_tasks.yml',
+        encoder_workers = 2,
+        encoder_queue_size = 16,
+        catchup_policy = 'skip',
+        capture_mode = 'full',
+        capture_source = 'x11',
+        encoder_backend = 'thread',
+        event_flush_interval = 1.0,
+        event_fsync_policy = 'batch',
+        event_log_format = 'jsonl',
     ):
         self.do_recording = self._bool(do_recording)
         self.screenshot_interval = float(screenshot_interval)
         self.script_rule_name = script_rule_name
         self.task_sequence_name = task_sequence_name
+        self.encoder_workers = int(encoder_workers)
+        self.encoder_queue_size = int(encoder_queue_size)
+        self.catchup_policy = catchup_policy
+        self.capture_mode = capture_mode
+        self.capture_source = capture_source
+        self.encoder_backend = encoder_backend
+        self.event_flush_interval = float(event_flush_interval)
+        self.event_fsync_policy = event_fsync_policy
+        self.event_log_format = event_log_format
 
     def get_description(self):
         return [
@@ -83,6 +107,15 @@ class ControllerConfig(object):
             ('screenshot_interval', self.screenshot_interval),
             ('script_rule_name', self.script_rule_name),
             ('task_sequence_name', self.task_sequence_name),
+            ('encoder_workers', self.encoder_workers),
+            ('encoder_queue_size', self.encoder_queue_size),
+            ('catchup_policy', self.catchup_policy),
+            ('capture_mode', self.capture_mode),
+            ('capture_source', self.capture_source),
+            ('encoder_backend', self.encoder_backend),
+            ('event_flush_interval', self.event_flush_interval),
+            ('event_fsync_policy', self.event_fsync_policy),
+            ('event_log_format', self.event_log_format),
         ]
         
     @property
@@ -325,18 +358,229 @@ class DriverWrapper(object):
 
 
 class EventWriter(object):
-    """VNC proxy and http server write events through this class."""
+    """VNC proxy and http server write events through this class.
+    Callers only append an event to a deque (no lock, no serialization and no I/O),
+    so logging does not delay the reactor that proxies the VNC stream.
+    A writer thread serializes events and writes lines in batches to a file 
+    kept open during a recording. It polls the deque every poll_interval while the file is open
+    and blocks while nothing is recorded. Events that reach the writer after the file is closed
+    (pushed while stop() runs) are counted as discarded.
+    A batch is written when it exceeds flush_size bytes or flush_interval seconds,
+    and on stop(). A batch consists of whole lines and is written with a single call,
+    so the file ends with a complete line after each batch.
+    fsync_policy:
+        none: leave syncing to the OS.
+        batch: fsync after each batch.
+    log_format:
+        jsonl: json lines (events.txt)
+        binary: records defined in eventlog.py (events.bin)
+    """
     
-    def __init__(self):
+    fsync_policies = ('none', 'batch')
+    log_formats = ('jsonl', 'binary')
+    
+    def __init__(self, flush_size=64*1024, flush_interval=1.0, fsync_policy='batch', poll_interval=0.02,
+                 log_format='jsonl'):
     
         self.running = False
         self.path = None
         self.default_data = {}
+        
+        assert fsync_policy in self.fsync_policies, f'unknown fsync policy: {fsync_policy}'
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.fsync_policy = fsync_policy
+        self.poll_interval = poll_interval
+        assert log_format in self.log_formats, f'unknown log format: {log_format}'
+        self.log_format = log_format
+        
+        # handoff from the caller threads to the writer thread
+        # deque.append and deque.popleft are atomic
+        self.pending = collections.deque()
+        self.thread = None
+        # wakes the writer thread blocked while no log is open (set by start() and stop())
+        self.wakeup = threading.Event()
+        
+        # cursor table shared by recordings: key -> cursor args
+        # cursors are added by the reactor thread with add_cursor()
+        self.cursors = {}
+        
+        # used only in the writer thread
+        self.file = None
+        self.cursor_file = None
+        self.written_cursors = set()
+        self.buffer = []
+        self.buffer_size = 0
+        self.t_last_flush = time.monotonic()
+        
+        # metrics
+        # the caller side cost is the time spent in push() and __call__().
+        # Each caller thread updates its own counters [events, total time, max time],
+        # so the counters are not lost without a lock. get_stats() sums them.
+        self.num_written = 0
+        # events pushed after the log was closed (a push racing with stop())
+        self.num_discarded = 0
+        self.caller_local = threading.local()
+        self.caller_counters = []
+    
+    def count_caller(self, t_start):
+        """Counts an event logged by the current thread since t_start (time.perf_counter())"""
+        
+        cost = time.perf_counter() - t_start
+        counters = getattr(self.caller_local, 'counters', None)
+        if counters is None:
+            counters = self.caller_local.counters = [0, 0.0, 0.0]
+            self.caller_counters.append(counters)
+        counters[0] += 1
+        counters[1] += cost
+        if cost > counters[2]:
+            counters[2] = cost
+    
+    @property
+    def file_name(self):
+        
+        if self.log_format == 'binary':
+            return eventlog.BINARY_FILE_NAME
+        return eventlog.JSONL_FILE_NAME
+    
+    def add_cursor(self, args):
+        """Registers a cursor and returns its key. 
+        Cursor events refer to the key instead of the cursor image."""
+        
+        key = eventlog.cursor_key(*args)
+        if key not in self.cursors:
+            self.cursors[key] = args
+        return key
     
-    def write(self, s):
+    def write_cursor(self, key):
+        """Writes a cursor to the cursor table of the recording 
+        before the first event that refers to it. This runs in the writer thread."""
         
-        with open(self.path, 'a') as f:
-            print(s, file=f)
+        if key in self.written_cursors or self.cursor_file is None:
+            return
+        args = self.cursors.get(key)
+        if args is None:
+            print(f'unknown cursor: {key}')
+            return
+        data = {'key': key, 'args': args}
+        self.cursor_file.write(json.dumps(data, default=eventlog.encode_bytes) + '\n')
+        self.cursor_file.flush()
+        self.written_cursors.add(key)
+    
+    def push(self, event, args, t=None):
+        """Logs an event with the given args. This is used by the reactor thread."""
+        
+        t_start = time.perf_counter()
+        if self.running and self.path:
+            self.pending.append((time.time() if t is None else t, event, args))
+            self.count_caller(t_start)
+    
+    def start_thread(self):
+        
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+    
+    def run(self):
+        
+        while True:
+            if self.file is None and not self.pending:
+                # nothing is recorded
+                self.wakeup.wait()
+                self.wakeup.clear()
+            else:
+                time.sleep(self.poll_interval)
+            try:
+                self.drain()
+            except Exception as e:
+                print('event writer error:', e)
+    
+    def drain(self):
+        """Serializes pending events. This runs in the writer thread."""
+        
+        while True:
+            try:
+                item = self.pending.popleft()
+            except IndexError:
+                break
+            
+            if isinstance(item, tuple):
+                if item[0] is None:
+                    # control items
+                    _, cmd, arg = item
+                    if cmd == 'open':
+                        self.close_file()
+                        if self.log_format == 'binary':
+                            self.file = open(arg, 'ab')
+                            if self.file.tell() == 0:
+                                # written at once so that the log is readable after a crash
+                                self.file.write(eventlog.encode_header())
+                                self.file.flush()
+                                if self.fsync_policy == 'batch':
+                                    os.fsync(self.file.fileno())
+                        else:
+                            self.file = open(arg, 'a')
+                        cursor_path = os.path.join(os.path.dirname(arg), eventlog.CURSOR_FILE_NAME)
+                        self.cursor_file = open(cursor_path, 'a')
+                    elif cmd == 'close':
+                        self.close_file()
+                        arg.set()
+                    continue
+                t, event, args = item
+            elif isinstance(item, dict):
+                t, event, args = item['time'], item['event'], item['args']
+            else:
+                ev = json.loads(item)
+                t, event, args = ev['time'], ev['event'], ev['args']
+            
+            if self.file is None:
+                self.num_discarded += 1
+                print(f'event after the log was closed was discarded: {event}')
+                continue
+            
+            if event == 'cursor':
+                self.write_cursor(args[0])
+            elif event == 'start' and 'cursor' in args[0]:
+                self.write_cursor(args[0]['cursor'][0])
+            
+            if self.log_format == 'binary':
+                line = eventlog.encode_event(t, event, args)
+            else:
+                data = {'time': t, 'event': event, 'args': args}
+                line = json.dumps(data, default=eventlog.encode_bytes) + '\n'
+            
+            self.buffer.append(line)
+            self.buffer_size += len(self.buffer[-1])
+            self.num_written += 1
+            if self.buffer_size >= self.flush_size:
+                self.flush_buffer()
+        
+        if time.monotonic() - self.t_last_flush >= self.flush_interval:
+            self.flush_buffer()
+    
+    def flush_buffer(self):
+        """Writes the buffered lines. This runs in the writer thread."""
+        
+        if self.buffer and self.file is not None:
+            self.file.write(type(self.buffer[0])().join(self.buffer))
+            self.file.flush()
+            if self.fsync_policy == 'batch':
+                os.fsync(self.file.fileno())
+        self.buffer.clear()
+        self.buffer_size = 0
+        self.t_last_flush = time.monotonic()
+    
+    def close_file(self):
+        """Writes the buffered lines and closes the file. This runs in the writer thread."""
+        
+        if self.file is not None:
+            self.flush_buffer()
+            self.file.close()
+            self.file = None
+        if self.cursor_file is not None:
+            self.cursor_file.close()
+            self.cursor_file = None
+        self.written_cursors.clear()
     
     def set_default(self, name, data):
         
@@ -344,42 +588,82 @@ class EventWriter(object):
     
     def start(self):
         
-        data = {
-            'time': time.time(),
-            'event': 'start',
-            'args': [self.default_data],
-        }
-        self.write(json.dumps(data))
+        self.start_thread()
+        self.pending.append((None, 'open', self.path))
+        self.pending.append((time.time(), 'start', [dict(self.default_data)]))
         self.running = True
+        self.wakeup.set()
     
-    def stop(self, args={}):
+    def stop(self, args={}, timeout=10):
+        """Stops logging. This waits until all events are written."""
         
         self.running = False
-        data = {
-            'time': time.time(),
-            'event': 'stop',
-            'args': [{'stop_args': args}],
-        }
-        self.write(json.dumps(data))
+        self.pending.append((time.time(), 'stop', [{'stop_args': args}]))
+        closed = threading.Event()
+        self.pending.append((None, 'close', closed))
+        self.wakeup.set()
+        closed.wait(timeout)
     
-    def __call__(self, s):
+    def __call__(self, data):
+        """Logs an event given as a dict with time, event and args"""
        
+        t_start = time.perf_counter()
         if self.running and self.path:
-            self.write(s)
+            self.pending.append(data)
+            self.count_caller(t_start)
+    
+    def get_stats(self):
+        
+        counters = list(self.caller_counters)
+        num_events = sum(c[0] for c in counters)
+        return {
+            'events': num_events,
+            'written': self.num_written,
+            'discarded': self.num_discarded,
+            'pending': len(self.pending),
+            'cursors': len(self.cursors),
+            'caller_cost_mean_us': sum(c[1] for c in counters) / max(1, num_events) * 1e6,
+            'caller_cost_max_us': max((c[2] for c in counters), default=0.0) * 1e6,
+        }
     
 
 class RecordingThared(threading.Thread):
     """Records screenshots with grabscreen_x11. 
-    We use a sub thread to take screenshots."""
+    We use a sub thread to take screenshots.
+    The thread only grabs raw frames. They are encoded by FrameEncoderPool
+    (threads) or ProcessFrameEncoderPool (processes with a shared memory ring).
+    The timestamps of frames are written to frames.txt,
+    and index.json of the frames on disk is written periodically and at the end (see record_index.py).
+    capture_source:
+        x11: frames are grabbed at the deadlines given by CaptureScheduler.
+        vnc: frames are taken from the framebuffer kept by the VNC proxy
+            when an update is committed (at most once in the interval).
+    capture_mode:
+        full: every frame is encoded.
+        damage: a frame same as the previous one is stored as a marker file (.ref)
+            that refers to the last encoded image."""
+    
+    capture_sources = ('x11', 'vnc')
+    capture_modes = ('full', 'damage')
+    encoder_backends = ('thread', 'process')
     
     @staticmethod
     def xgrab(xdisplay=DEFAULT_DISPLAY):
     
         size, data = PIL.Image.core.grabscreen_x11(xdisplay)
         return PIL.Image.frombytes("RGB", size, data, "raw", "BGRX", size[0] * 4, 1)
+    
+    @staticmethod
+    def xgrab_raw(xdisplay=DEFAULT_DISPLAY):
+        """Returns the size and the BGRX buffer of the screen"""
+        
+        return PIL.Image.core.grabscreen_x11(xdisplay)
 
     def __init__(self, stop_event, interval, working_dir_path, writer, 
-                 do_recording=True, duration=None, after_auto_stop=None, stop_args={}):
+                 do_recording=True, duration=None, after_auto_stop=None, stop_args={},
+                 encoder_workers=2, encoder_queue_size=16, catchup_policy='skip',
+                 capture_mode='full', capture_source='x11', frame_stream=None,
+                 encoder_backend='thread'):
         
         super().__init__()
         self.stop_event = stop_event
@@ -390,6 +674,75 @@ class RecordingThared(threading.Thread):
         self.duration = duration
         self.after_auto_stop = after_auto_stop
         self.stop_args = stop_args
+        self.encoder_workers = encoder_workers
+        self.encoder_queue_size = encoder_queue_size
+        self.catchup_policy = catchup_policy
+        self.capture_mode = capture_mode
+        self.capture_source = capture_source
+        self.frame_stream = frame_stream
+        self.encoder_backend = encoder_backend
+        self.encoder_pool = None
+        self.scheduler = None
+        self.num_unchanged = 0
+    
+    def get_stats(self):
+        
+        stats = {'unchanged': self.num_unchanged}
+        if self.encoder_pool is not None:
+            stats.update(self.encoder_pool.get_stats())
+        if self.scheduler is not None:
+            stats['scheduler'] = self.scheduler.get_stats()
+        return stats
+    
+    def iter_x11_frames(self):
+        """Yields frames grabbed at the scheduled deadlines.
+        Each frame is (index, t_wall, t_mono, deadline, size, data, rawmode)."""
+        
+        self.scheduler = CaptureScheduler(self.interval, self.catchup_policy)
+        while True:
+            frame = self.scheduler.wait(self.stop_event)
+            if frame is None:
+                break
+            index, deadline = frame
+            t_mono = time.monotonic()
+            t_wall = time.time()
+            size, data = self.xgrab_raw()
+            yield index, t_wall, t_mono, deadline, size, data, 'BGRX'
+    
+    def iter_vnc_frames(self):
+        """Yields frames committed to the framebuffer of the VNC proxy.
+        The current frame is yielded at the beginning and the end of the recording
+        so that the image timeline covers the whole recording."""
+        
+        frame_queue = self.frame_stream.open(min_interval=self.interval)
+        try:
+            index = 0
+            if self.frame_stream.snapshot_func is None:
+                print('no VNC session keeps a framebuffer: '
+                      'connect the viewer again after capture_source is set to vnc')
+            frame = self.frame_stream.snapshot()
+            if frame is not None:
+                # the screen at the beginning
+                t_wall, t_mono, size, rows, rawmode = frame
+                yield index, time.time(), time.monotonic(), None, size, b''.join(rows), rawmode
+                index += 1
+            
+            while not self.stop_event.is_set():
+                try:
+                    t_wall, t_mono, size, rows, rawmode = frame_queue.get(timeout=self.interval)
+                except queue.Empty:
+                    continue
+                # rows are joined here, not on the reactor thread
+                yield index, t_wall, t_mono, None, size, b''.join(rows), rawmode
+                index += 1
+            
+            frame = self.frame_stream.snapshot()
+            if frame is not None:
+                # the screen at the end
+                t_wall, t_mono, size, rows, rawmode = frame
+                yield index, time.time(), time.monotonic(), None, size, b''.join(rows), rawmode
+        finally:
+            self.frame_stream.close()
 
     def run(self):
         
@@ -406,18 +759,79 @@ class RecordingThared(threading.Thread):
         
         if self.do_recording:
         
-            self.writer.path = os.path.join(self.working_dir_path, 'events.txt')
+            self.writer.path = os.path.join(self.working_dir_path, self.writer.file_name)
             self.writer.start()
             
-            elapsed = 0
-            while not self.stop_event.wait(max(0, self.interval - elapsed)):
-                t_start = time.time()
-                image = self.xgrab()
-                path = os.path.join(self.working_dir_path, f'{time.time()}.jpg')
-                image.save(path)
-                elapsed = time.time() - t_start
-        
-            self.writer.stop(self.stop_args)
+            if self.encoder_backend == 'process':
+                encoder_pool_class = ProcessFrameEncoderPool
+            else:
+                encoder_pool_class = FrameEncoderPool
+            self.encoder_pool = encoder_pool_class(
+                num_workers=self.encoder_workers, 
+                max_queue=self.encoder_queue_size,
+            )
+            
+            if self.capture_source == 'vnc':
+                frames = self.iter_vnc_frames()
+            else:
+                frames = self.iter_x11_frames()
+            
+            # The timeline of frames is anchored to the wall clock once
+            # and advanced by the monotonic clock.
+            # Clock adjustments during recording do not change the order of frames.
+            t_mono_origin = time.monotonic()
+            t_wall_origin = time.time()
+            
+            damage = TileChecksum() if self.capture_mode == 'damage' else None
+            last_name = None
+            index_builder = record_index.IndexBuilder(self.working_dir_path)
+            
+            frame_log_path = os.path.join(self.working_dir_path, 'frames.txt')
+            with open(frame_log_path, 'a') as frame_log:
+                for index, t_wall, t_mono, deadline, size, data, rawmode in frames:
+                    t = t_wall_origin + (t_mono - t_mono_origin)
+                    changed = True
+                    if damage is not None:
+                        changed = len(damage.update(size, data)) > 0 or last_name is None
+                    if not changed:
+                        # nothing changed since the last encoded frame
+                        name = f'{t}.ref'
+                        job = MarkerJob(os.path.join(self.working_dir_path, name), last_name)
+                        self.num_unchanged += 1
+                    else:
+                        name = f'{t}.jpg'
+                        job = FrameJob(os.path.join(self.working_dir_path, name), size, data, rawmode)
+                    
+                    submitted = self.encoder_pool.submit(job)
+                    if submitted:
+                        index_builder.add(t, name, name if changed else last_name, size)
+                    else:
+                        index_builder.add_dropped()
+                    index_builder.flush()
+                    if changed:
+                        last_name = name if submitted else None
+                        if damage is not None and not submitted:
+                            # the next frame must be encoded since this frame was dropped
+                            damage.reset()
+                    
+                    frame_data = {
+                        'index': index,
+                        'time': t,
+                        'wall': t_wall,
+                        'monotonic': t_mono,
+                        'deadline': deadline,
+                        'name': name,
+                        'dropped': not submitted,
+                    }
+                    print(json.dumps(frame_data), file=frame_log)
+            
+            # wait for the frames in the queue
+            self.encoder_pool.close()
+            index_builder.write()
+            stats = self.get_stats()
+            print('capture stats:', stats)
+            
+            self.writer.stop(dict(self.stop_args, capture_stats=stats))
         
         else:
             
@@ -431,11 +845,12 @@ class RecordingThared(threading.Thread):
 class TornadoThread(threading.Thread):
     """Tornado runs in a sub thread to use twisted and tornado in a process."""
     
-    def __init__(self, writer, config):
+    def __init__(self, writer, config, frame_stream=None):
 
         super().__init__()
         self.writer = writer
         self.config = config
+        self.frame_stream = frame_stream
         self.stop_event = None
 
     def run(self):
@@ -444,7 +859,7 @@ class TornadoThread(threading.Thread):
 
     async def main(self):
         
-        app = Application(self.writer, self.config)
+        app = Application(self.writer, self.config, self.frame_stream)
         app.listen(CONTROLLER_PORT)
         self.stop_event = asyncio.Event()
         await self.stop_event.wait()
@@ -472,9 +887,10 @@ class Application(tornado.web.Application):
         
         return datetime.datetime.now().strftime('rec-%Y-%m-%dT%H%M%S')
     
-    def __init__(self, writer, config):
+    def __init__(self, writer, config, frame_stream=None):
         
         self.writer = writer
+        self.frame_stream = frame_stream
         self.driver_wrapper = DriverWrapper()
         
         self.config = None
@@ -482,11 +898,18 @@ class Application(tornado.web.Application):
         
         self.grab_stop = threading.Event()
         self.grab_stop.set()
+        self.recording_thread = None
+        
+        self.conversion_thread = ConversionThread()
+        self.conversion_thread.start()
+        
+        self.record_list = RecordList(RECORDS_DIR_PATH)
         
         handlers = [
             # global functions
             (r"/reload", ReloadHandler),
             (r"/convert", ConvertHandler),
+            (r"/convert/status", ConvertStatusHandler),
             # webui
             (r"/webui/(.*)", WebUIHandler),
             (r"/static/(.*)", tornado.web.StaticFileHandler, {
@@ -503,9 +926,34 @@ class Application(tornado.web.Application):
         super().__init__(handlers, **settings)
     
     def set_config(self, config):
-        
-        self.task_sequence = TaskSequence(config.task_sequence_path)
-        self.script_rule = ScriptInjectionRule(config.script_rule_path)
+        """Applies a config. 
+        Raises ValueError without changing anything if a value of the config is unknown."""
+        
+        # checked here because the recording thread cannot report an error
+        choices = (
+            ('event_fsync_policy', EventWriter.fsync_policies),
+            ('event_log_format', EventWriter.log_formats),
+            ('catchup_policy', CaptureScheduler.policies),
+            ('capture_source', RecordingThared.capture_sources),
+            ('capture_mode', RecordingThared.capture_modes),
+            ('encoder_backend', RecordingThared.encoder_backends),
+        )
+        for name, values in choices:
+            value = getattr(config, name)
+            if value not in values:
+                raise ValueError(f'unknown {name}: {value} (one of {", ".join(values)})')
+        
+        task_sequence = TaskSequence(config.task_sequence_path)
+        script_rule = ScriptInjectionRule(config.script_rule_path)
+        
+        self.task_sequence = task_sequence
+        self.script_rule = script_rule
+        self.writer.flush_interval = config.event_flush_interval
+        self.writer.fsync_policy = config.event_fsync_policy
+        self.writer.log_format = config.event_log_format
+        if self.frame_stream is not None:
+            # VNC sessions connected after this keep a framebuffer only for capture_source=vnc
+            self.frame_stream.enabled = config.capture_source == 'vnc'
         self.config = config
     
     def start_recording_thread(self, interval, duration, prefix, after_auto_stop=None):
@@ -533,8 +981,16 @@ class Application(tornado.web.Application):
             duration=duration,
             after_auto_stop=after_auto_stop,
             stop_args=dict(self.config.get_description()),
+            encoder_workers=self.config.encoder_workers,
+            encoder_queue_size=self.config.encoder_queue_size,
+            catchup_policy=self.config.catchup_policy,
+            capture_mode=self.config.capture_mode,
+            capture_source=self.config.capture_source,
+            frame_stream=self.frame_stream,
+            encoder_backend=self.config.encoder_backend,
         )
         thread.start()
+        self.recording_thread = thread
         return True
     
     def stop_recording_thread(self):
@@ -607,7 +1063,7 @@ class TaskHandler(tornado.web.RequestHandler):
             'event': 'task',
             'args': [{'task_args': ['go', url]}],
         }
-        self.application.writer(json.dumps(data))
+        self.application.writer(data)
     
     def get_welcome(self):
         
@@ -643,7 +1099,7 @@ class TaskHandler(tornado.web.RequestHandler):
             'event': 'task',
             'args': [{'task_args': ['move_to_next', task['url']]}],
         }
-        self.application.writer(json.dumps(data))
+        self.application.writer(data)
     
     def get_start_sequence(self):
         
@@ -666,7 +1122,7 @@ class TaskHandler(tornado.web.RequestHandler):
             'event': 'task',
             'args': [{'task_args': ['start_sequence']}],
         }
-        self.application.writer(json.dumps(data))
+        self.application.writer(data)
         
         # move to the first task
         try:
@@ -689,7 +1145,7 @@ class TaskHandler(tornado.web.RequestHandler):
             'event': 'task',
             'args': [{'task_args': task_args}],
         }
-        self.application.writer(json.dumps(data))
+        self.application.writer(data)
         
         print(task_args)
         
@@ -707,7 +1163,7 @@ class TaskHandler(tornado.web.RequestHandler):
             'event': 'task',
             'args': [{'task_args': task_args}],
         }
-        self.application.writer(json.dumps(data))
+        self.application.writer(data)
         
         print(task_args)
         
@@ -733,6 +1189,8 @@ class GrabHandler(tornado.web.RequestHandler):
             self.get_start()
         elif cmd == 'stop':
             self.get_stop()
+        elif cmd == 'stats':
+            self.get_stats()
         else:
             self.write(f'unknown: {cmd}')
     
@@ -757,6 +1215,13 @@ class GrabHandler(tornado.web.RequestHandler):
         
         self.application.stop_recording_thread()
         self.write('stopped')
+    
+    def get_stats(self):
+        
+        thread = self.application.recording_thread
+        stats = thread.get_stats() if thread is not None else {}
+        stats['event_writer'] = self.application.writer.get_stats()
+        self.write(stats)
 
 
 class ReloadHandler(tornado.web.RequestHandler):
@@ -766,37 +1231,199 @@ class ReloadHandler(tornado.web.RequestHandler):
         config = self.get_argument('config', None)
         if config:
             config_dict = json.loads(tornado.escape.url_unescape(config))
-            self.application.set_config(ControllerConfig(**config_dict))
+            try:
+                self.application.set_config(ControllerConfig(**config_dict))
+            except (TypeError, ValueError) as e:
+                self.set_status(400)
+                self.write(f'invalid config: {e}')
+                return
             self.write('done')
         else:
             self.write('config is missing')
 
 
-class ConvertHandler(tornado.web.RequestHandler):
-
-    def get(self):
+class ConversionThread(threading.Thread):
+    """Converts records in the background so that the tornado thread is not blocked.
+    Records are converted one by one in the submitted order.
+    A job is a dict with id, name, state (queued, running, done or failed) and progress."""
+    
+    max_finished_jobs = 100
+    
+    def __init__(self, base_interval=0.1):
+        
+        super().__init__(daemon=True)
+        self.base_interval = base_interval
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.jobs = collections.OrderedDict()
+        self.next_id = 1
+    
+    def submit(self, name):
+        """Queues a record and returns the job id.
+        A record already queued or running is not queued again."""
+        
+        with self.lock:
+            for job in self.jobs.values():
+                if job['name'] == name and job['state'] in ('queued', 'running'):
+                    return job['id']
+            
+            job = {
+                'id': self.next_id,
+                'name': name,
+                'state': 'queued',
+                'done': 0,
+                'total': None,
+                't_start': None,
+                't_end': None,
+                'error': None,
+            }
+            self.next_id += 1
+            self.jobs[job['id']] = job
+            
+            # forget old finished jobs
+            finished = [k for k, v in self.jobs.items() if v['state'] in ('done', 'failed')]
+            for k in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+                del self.jobs[k]
         
-        name = self.get_argument('name', None)
-        if name is None:
-            self.write('record not found')
-            return
+        self.queue.put(job['id'])
+        return job['id']
+    
+    def get_status(self, job_id=None):
+        """Returns copies of the jobs with elapsed time and ETA in seconds"""
+        
+        now = time.time()
+        with self.lock:
+            jobs = [dict(v) for k, v in self.jobs.items() if job_id is None or k == job_id]
+        
+        for job in jobs:
+            job['elapsed'] = None
+            job['eta'] = None
+            if job['t_start'] is not None:
+                job['elapsed'] = (job['t_end'] or now) - job['t_start']
+                if job['state'] == 'running' and job['done'] and job['total']:
+                    job['eta'] = job['elapsed'] / job['done'] * (job['total'] - job['done'])
+        return jobs
+    
+    def get_state(self, name):
+        """Returns the state of the last job of a record, or None"""
+        
+        with self.lock:
+            for job in reversed(self.jobs.values()):
+                if job['name'] == name:
+                    if job['state'] == 'running' and job['total']:
+                        return f"running {job['done']}/{job['total']}"
+                    return job['state']
+        return None
+    
+    def set_progress(self, job_id, done, total):
+        
+        with self.lock:
+            self.jobs[job_id]['done'] = done
+            self.jobs[job_id]['total'] = total
+    
+    def run(self):
+        
+        while True:
+            job_id = self.queue.get()
+            with self.lock:
+                job = self.jobs[job_id]
+                job['state'] = 'running'
+                job['t_start'] = time.time()
+                name = job['name']
+            
+            try:
+                self.convert(job_id, name)
+                state, error = 'done', None
+            except Exception as e:
+                print('conversion failed:', name, e)
+                state, error = 'failed', str(e)
+            
+            with self.lock:
+                job['state'] = state
+                job['error'] = error
+                job['t_end'] = time.time()
+    
+    def convert(self, job_id, name):
         
         record_path = os.path.join(RECORDS_DIR_PATH, name)
         converted_path = os.path.join(CONVERTED_DIR_PATH, name)
         
-        if not os.path.exists(record_path):
-            self.write('record not found')
-            return
-        
         # change the owner of record_path      
+        # This is done before the conversion, which hardlinks source images into converted_path,
+        # so the chown of converted_path below does not change the owner of files in the record:
+        # they are already owned by user.
         subprocess.run(["chown", "-R", "user:user", record_path])
         
-        serializer.serialize(record_path, converted_path, 0.1)
+        serializer.serialize(
+            record_path, converted_path, self.base_interval,
+            progress=lambda done, total: self.set_progress(job_id, done, total),
+        )
         
         # change the owner of converted_path       
         subprocess.run(["chown", "-R", "user:user", converted_path])
+
+
+class RecordList(object):
+    """Lists the records and the summaries of their indexes for the web UI.
+    The list is made again only when the directory of records is changed.
+    A complete summary is read once; a record without it (e.g. being recorded) is checked again."""
+    
+    def __init__(self, records_dir_path):
         
-        self.write('done')
+        self.records_dir_path = records_dir_path
+        self.mtime_ns = None
+        # name -> summary or None
+        self.summaries = {}
+    
+    def get(self):
+        """Returns a list of (name, summary or None)"""
+        
+        mtime_ns = os.stat(self.records_dir_path).st_mtime_ns
+        if mtime_ns != self.mtime_ns:
+            self.mtime_ns = mtime_ns
+            summaries = {}
+            for name in os.listdir(self.records_dir_path):
+                if os.path.isdir(os.path.join(self.records_dir_path, name)):
+                    summaries[name] = self.summaries.get(name)
+            self.summaries = summaries
+        
+        for name, summary in self.summaries.items():
+            if summary is None or not summary['complete']:
+                self.summaries[name] = record_index.read_summary(os.path.join(self.records_dir_path, name))
+        
+        return sorted(self.summaries.items())
+
+
+class ConvertHandler(tornado.web.RequestHandler):
+    """Queues records to convert and returns the job ids immediately.
+    Several records can be given as /convert?name=a&name=b"""
+
+    def get(self):
+        
+        names = self.get_arguments('name')
+        if not names:
+            self.write('record not found')
+            return
+        
+        for name in names:
+            if not os.path.isdir(os.path.join(RECORDS_DIR_PATH, name)):
+                self.write('record not found')
+                return
+        
+        conversion_thread = self.application.conversion_thread
+        jobs = [{'id': conversion_thread.submit(name), 'name': name} for name in names]
+        self.write({'jobs': jobs})
+
+
+class ConvertStatusHandler(tornado.web.RequestHandler):
+    """Reports the progress of conversion jobs (all jobs if id is not given)"""
+    
+    def get(self):
+        
+        job_id = self.get_argument('id', None)
+        if job_id is not None:
+            job_id = int(job_id)
+        self.write({'jobs': self.application.conversion_thread.get_status(job_id)})
 
 
 class WebUIHandler(tornado.web.RequestHandler):
@@ -836,20 +1463,28 @@ class WebUIHandler(tornado.web.RequestHandler):
     
     def get_records(self):
         
+        converted_names = set(os.listdir(CONVERTED_DIR_PATH)) if os.path.exists(CONVERTED_DIR_PATH) else set()
+        
         records = []
-        for name in sorted(os.listdir(RECORDS_DIR_PATH)):
-            file_path = os.path.join(RECORDS_DIR_PATH, name)
-            if os.path.isdir(file_path):
-                converted_path = os.path.join(CONVERTED_DIR_PATH, name)
-                is_converted = os.path.exists(converted_path)
-                convert_button =  f'<button onclick="convert(\'{name}\')">convert</button>'
-                if is_converted:
-                    conversion_state = 'done'
-                    preview_path = f'<a href="/webui/preview?name={name}">link</a>'
-                else:
-                    conversion_state = 'yet'
-                    preview_path = ''
-                records.append((name, convert_button, conversion_state, preview_path))
+        for name, summary in self.application.record_list.get():
+            is_converted = name in converted_names
+            convert_button =  f'<button onclick="convert(\'{name}\')">convert</button>'
+            job_state = self.application.conversion_thread.get_state(name)
+            if job_state is not None and job_state != 'done':
+                conversion_state = job_state
+                preview_path = ''
+            elif is_converted:
+                conversion_state = 'done'
+                preview_path = f'<a href="/webui/preview?name={name}">link</a>'
+            else:
+                conversion_state = 'yet'
+                preview_path = ''
+            frames = ''
+            if summary is not None and summary['num_frames']:
+                frames = f"{summary['num_frames']} ({summary['time_max'] - summary['time_min']:.0f} s)"
+                if not summary['complete']:
+                    frames += ' incomplete'
+            records.append((name, convert_button, conversion_state, preview_path, frames))
         
         env = self.application.get_global_envs()
         env['records'] = records
@@ -882,8 +1517,9 @@ if __name__ == "__main__":
     
     writer = EventWriter()
     config = ControllerConfig()
+    frame_stream = FrameStream()
     
-    tornado_thread = TornadoThread(writer, config)
+    tornado_thread = TornadoThread(writer, config, frame_stream)
     tornado_thread.start()
     print('tornado_thread started')
     
@@ -892,6 +1528,7 @@ if __name__ == "__main__":
             port=VNC_SERVER_PORT,
             password_required=True,
             writer=writer,
+            frame_stream=frame_stream,
             pseudocursor=True,
         )
     factory.protocol = CustomVNCLoggingServerProxyEx
@@ -0,0 +1,168 @@
+# coding: utf-8
+# Binary event log for RecVNC
+#
+# events.bin holds the same events as events.txt (json lines) in a compact form.
+#
+# header: magic (4 bytes) + version (uint16) + reserved (uint16)
+# records: type (uint8) + time (float64) + payload
+#     pointer: x (uint16), y (uint16), button_mask (uint8)
+#     key: key (uint32), down (uint8)
+#     blob: length (uint32) + json bytes of [event, args]
+#           used for the other events (cursor, task, start, stop, ...)
+# All values are little endian.
+#
+# Cursor images are not in the event logs.
+# Each distinct cursor is written once to cursors.txt (json lines of key and args),
+# and cursor events refer to it with the key, a hash of the cursor.
+#
+
+import json
+import base64
+import struct
+import hashlib
+
+
+MAGIC = b'RGEV'
+VERSION = 1
+
+HEADER = struct.Struct('<4sHH')
+RECORD_HEAD = struct.Struct('<Bd')
+POINTER = struct.Struct('<HHB')
+KEY = struct.Struct('<IB')
+BLOB = struct.Struct('<I')
+
+TYPE_POINTER = 1
+TYPE_KEY = 2
+TYPE_BLOB = 3
+
+JSONL_FILE_NAME = 'events.txt'
+BINARY_FILE_NAME = 'events.bin'
+CURSOR_FILE_NAME = 'cursors.txt'
+
+
+def encode_bytes(x):
+    """Raw bytes in event args (e.g. cursor images) are written in base64"""
+
+    if isinstance(x, (bytes, bytearray)):
+        return base64.b64encode(x).decode('utf-8')
+    raise TypeError(f'not serializable: {type(x)}')
+
+
+def cursor_key(x, y, width, height, image, mask):
+    """Returns the key of a cursor in the cursor table"""
+
+    h = hashlib.sha1(struct.pack('<iiII', x, y, width, height))
+    h.update(image or b'')
+    h.update(mask or b'')
+    return h.hexdigest()
+
+
+def encode_header():
+
+    return HEADER.pack(MAGIC, VERSION, 0)
+
+
+def encode_event(t, event, args):
+    """Returns the bytes of a record"""
+
+    if event == 'pointer':
+        return RECORD_HEAD.pack(TYPE_POINTER, t) + POINTER.pack(*args)
+    elif event == 'key':
+        return RECORD_HEAD.pack(TYPE_KEY, t) + KEY.pack(args[0], int(args[1]))
+
+    blob = json.dumps([event, args], default=encode_bytes).encode('utf-8')
+    return RECORD_HEAD.pack(TYPE_BLOB, t) + BLOB.pack(len(blob)) + blob
+
+
+def iter_binary_events(buffer):
+    """Yields (time, event, args) from the bytes of a binary log.
+    An incomplete last record, left by a crash during writing, is ignored.
+    A log shorter than the header has no events."""
+
+    if len(buffer) < HEADER.size:
+        return
+
+    magic, version, _ = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise RuntimeError('not a binary event log')
+    if version > VERSION:
+        raise RuntimeError(f'unsupported version: {version}')
+
+    pos = HEADER.size
+    end = len(buffer)
+    head_size = RECORD_HEAD.size
+
+    while pos + head_size <= end:
+        _type, t = RECORD_HEAD.unpack_from(buffer, pos)
+        pos += head_size
+
+        if _type == TYPE_POINTER:
+            if pos + POINTER.size > end:
+                break
+            yield t, 'pointer', list(POINTER.unpack_from(buffer, pos))
+            pos += POINTER.size
+
+        elif _type == TYPE_KEY:
+            if pos + KEY.size > end:
+                break
+            yield t, 'key', list(KEY.unpack_from(buffer, pos))
+            pos += KEY.size
+
+        elif _type == TYPE_BLOB:
+            if pos + BLOB.size > end:
+                break
+            (length,) = BLOB.unpack_from(buffer, pos)
+            pos += BLOB.size
+            if pos + length > end:
+                break
+            event, args = json.loads(buffer[pos:pos+length])
+            yield t, event, args
+            pos += length
+
+        else:
+            raise RuntimeError(f'unknown record type: {_type}')
+
+    if pos != end:
+        print('incomplete last record was ignored')
+
+
+def read_binary_events(file_path):
+    """Reads a binary log into the same form as the json lines:
+    a list of dicts with time, event and args."""
+
+    with open(file_path, 'rb') as f:
+        buffer = f.read()
+
+    return [{'time': t, 'event': event, 'args': args}
+            for t, event, args in iter_binary_events(buffer)]
+
+
+def jsonl_to_binary(src_path, dst_path):
+
+    with open(src_path) as f, open(dst_path, 'wb') as g:
+        g.write(encode_header())
+        for line in f:
+            if line.strip():
+                ev = json.loads(line)
+                g.write(encode_event(ev['time'], ev['event'], ev['args']))
+
+
+def binary_to_jsonl(src_path, dst_path):
+
+    with open(dst_path, 'w') as g:
+        for ev in read_binary_events(src_path):
+            print(json.dumps(ev), file=g)
+
+
+if __name__ == '__main__':
+
+    import sys
+
+    if len(sys.argv) != 4 or sys.argv[1] not in ('to_binary', 'to_jsonl'):
+        print(f'usage: {sys.argv[0]} to_binary|to_jsonl SRC DST')
+        sys.exit(1)
+
+    if sys.argv[1] == 'to_binary':
+        jsonl_to_binary(sys.argv[2], sys.argv[3])
+    else:
+        binary_to_jsonl(sys.argv[2], sys.argv[3])
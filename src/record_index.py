@@ -0,0 +1,128 @@
+# coding: utf-8
+# Index of a record for RecVNC
+#
+# index.json is written by the recording thread every flush_interval during recording
+# and once more when the recording ends.
+#     frames: [time, image file name] of the frames on disk, sorted by time.
+#             A marker frame (.ref) has the name of the image it refers to.
+#     complete: false while recording. An incomplete index lists only the frames
+#               up to time_max; later frames (e.g. after a crash) are on disk but not listed.
+#     and the summary below.
+# summary.json has the same fields without frames, so the record list does not parse the frames.
+#     image_size: [width, height] of the frames
+#     num_frames, num_images, num_markers, num_dropped: counts of the frames
+#     time_min, time_max: the range of the frame timestamps (null if no frame)
+# Readers use them instead of listing the directory and parsing the file names.
+# Records without index.json (old records) are scanned as before.
+#
+
+import os
+import json
+import time
+
+
+INDEX_FILE_NAME = 'index.json'
+SUMMARY_FILE_NAME = 'summary.json'
+INDEX_VERSION = 2
+
+
+def read_json(record_path, file_name):
+
+    file_path = os.path.join(record_path, file_name)
+    try:
+        with open(file_path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if data.get('version') != INDEX_VERSION:
+        return None
+    return data
+
+
+def read_index(record_path):
+    """Returns the index of a record, or None if it has no valid index"""
+
+    return read_json(record_path, INDEX_FILE_NAME)
+
+
+def read_summary(record_path):
+    """Returns the summary of a record (the index without frames), or None if it has no valid summary"""
+
+    return read_json(record_path, SUMMARY_FILE_NAME)
+
+
+def write_json(record_path, file_name, data):
+
+    file_path = os.path.join(record_path, file_name)
+    temp_file = file_path + '.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump(data, f)
+    os.replace(temp_file, file_path)
+
+
+class IndexBuilder(object):
+    """Collects the frames of a recording and writes index.json and summary.json"""
+
+    def __init__(self, record_path, flush_interval=10.0):
+
+        self.record_path = record_path
+        self.flush_interval = flush_interval
+        # (time, file name, image file name)
+        self.frames = []
+        self.image_size = None
+        self.num_dropped = 0
+        self.last_flush = time.monotonic()
+
+    def add(self, t, name, image_name, size):
+
+        self.frames.append((t, name, image_name))
+        self.image_size = size
+
+    def add_dropped(self):
+
+        self.num_dropped += 1
+
+    def flush(self):
+        """Writes an incomplete index if flush_interval has passed since the last one.
+        Frames still being encoded are not listed yet."""
+
+        now = time.monotonic()
+        if now - self.last_flush < self.flush_interval:
+            return None
+        self.last_flush = now
+        return self.write(complete=False)
+
+    def write(self, complete=True):
+        """Writes the index. Call this after the frames are written.
+        Frames that are not on disk (e.g. failed to be encoded) are not listed.
+        An incomplete index stops at the first frame not on disk,
+        so every frame after time_max is found by scanning the directory."""
+
+        names = set(os.listdir(self.record_path))
+        frames = []
+        num_markers = 0
+        for t, name, image_name in sorted(self.frames):
+            if name in names and image_name in names:
+                frames.append([t, image_name])
+                num_markers += int(name != image_name)
+            elif not complete:
+                break
+
+        summary = {
+            'version': INDEX_VERSION,
+            'complete': complete,
+            'image_size': list(self.image_size) if self.image_size else None,
+            'num_frames': len(frames),
+            'num_images': len(frames) - num_markers,
+            'num_markers': num_markers,
+            'num_dropped': self.num_dropped + (len(self.frames) - len(frames) if complete else 0),
+            'time_min': frames[0][0] if frames else None,
+            'time_max': frames[-1][0] if frames else None,
+        }
+        index = dict(summary, frames=frames)
+
+        # the index first, so a summary never describes frames missing in the index
+        write_json(self.record_path, INDEX_FILE_NAME, index)
+        write_json(self.record_path, SUMMARY_FILE_NAME, summary)
+        return index
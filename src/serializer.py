@@ -9,13 +9,24 @@
 # key settings, event definitions, interval, recorddata 
 # 
 
+import io
 import os
 import re
 import json
+import mmap
+import shutil
+import hashlib
 import base64
+import collections
+import multiprocessing
 import numpy as np
+import numpy.lib.recfunctions
 import PIL.Image
 
+import shard
+import eventlog
+import record_index
+
 
 # Key settings
 SPECIAL_KEYS = {
@@ -139,6 +150,26 @@ LAYOUT_US_STANDARD = {
 }
 
 
+def build_key_vocabulary():
+    """Returns the physical keys in the order of their ids (KI in the action arrays).
+    0 is no key and 1 is a key out of the vocabulary.
+    The order only depends on the key settings above, so the ids are stable."""
+    
+    keys = ['[None]', '[Unknown]']
+    keys.extend(SPECIAL_KEYS)
+    for code in range(0x21, 0x7f):
+        key = SPECIAL_KEYS_REV.get(code, None)
+        if key is None:
+            key = LAYOUT_US_STANDARD.get(chr(code), chr(code))
+        if key not in keys:
+            keys.append(key)
+    return keys
+
+
+KEY_VOCABULARY = build_key_vocabulary()
+KEY_IDS = {k:i for i, k in enumerate(KEY_VOCABULARY)}
+
+
 # Event definitions
 # - EventBase
 #     - ControlEvent
@@ -151,17 +182,34 @@ LAYOUT_US_STANDARD = {
 #     - KeyEvent
 #     - ButtonEvent
 #
+#
+# Events use __slots__ to save memory. 
+# Each arg is a field named by arg_names, and args gives the list of them.
+#
 class EventBase(object):
     
+    __slots__ = ('time_abs', 'time_origin_abs', 'time_rel')
+    
     name = 'base'
     repr_props = tuple()
+    arg_names = tuple()
     
-    def __init__(self, time_abs, time_origin_abs, args):
+    def __init__(self, time_abs, time_origin_abs, args, cursor_table=None):
         
         self.time_abs = time_abs
         self.time_origin_abs = time_origin_abs
         self.time_rel = time_abs - time_origin_abs
-        self.args = args
+        self.set_args(args)
+    
+    def set_args(self, args):
+        
+        for name, value in zip(self.arg_names, args):
+            setattr(self, name, value)
+    
+    @property
+    def args(self):
+        
+        return [getattr(self, name) for name in self.arg_names]
     
     @property
     def timestamp(self):
@@ -176,16 +224,22 @@ class EventBase(object):
 
 class ControlEvent(EventBase):
     
+    __slots__ = ('control_args', 'cursor', 'msg', 'subargs', 'stop_args')
+    
     name = 'control'
+    arg_names = ('control_args',)
     
-    def __init__(self, time_abs, time_origin_abs, args):
+    def __init__(self, time_abs, time_origin_abs, args, cursor_table=None):
         
         super().__init__(time_abs, time_origin_abs, args)
         
+        if cursor_table is None:
+            cursor_table = CursorTable()
+        
         # make objects for sub arguments
         for k, v in args[0].items():
             if k == 'cursor':
-                self.cursor = CursorHolder(*v)
+                self.cursor = cursor_table.get(v)
             elif k == 'task_args':
                 self.msg = v[0]
                 self.subargs = v[1:]
@@ -197,79 +251,203 @@ class ControlEvent(EventBase):
 
 class StartEvent(ControlEvent):
     
+    __slots__ = ()
+    
     name = 'start'
                 
 
 class StopEvent(ControlEvent):
     
+    __slots__ = ()
+    
     name = 'stop'
     repr_props = ('stop_args',)
 
 class TaskEvent(ControlEvent):
     
+    __slots__ = ()
+    
     name = 'task'
     repr_props = ('msg', 'subargs')
     
     
 class CursorHolder(object):
+    """A cursor image. 
+    Use get() to share the decoded holders of the same cursor args."""
+    
+    # digest of the args -> holder, the least recently used first.
+    # The cache is bounded because conversions run in the long-lived controller process.
+    cache = collections.OrderedDict()
+    max_cache_size = 64
+    
+    @classmethod
+    def get(cls, ox, oy, width, height, str_image, str_mask):
+        
+        key = eventlog.cursor_key(
+            ox, oy, width, height, (str_image or '').encode('utf-8'), (str_mask or '').encode('utf-8'))
+        holder = cls.cache.get(key)
+        if holder is None:
+            holder = cls(ox, oy, width, height, str_image, str_mask)
+            cls.cache[key] = holder
+            if len(cls.cache) > cls.max_cache_size:
+                cls.cache.popitem(last=False)
+        else:
+            cls.cache.move_to_end(key)
+        return holder
     
     def __init__(self, ox, oy, width, height, str_image, str_mask):
         
+        # raw args to make the same holder in other processes
+        self.args = (ox, oy, width, height, str_image, str_mask)
         self.ox = ox
         self.oy = oy
         self.size = (width, height)
         self.no_image = (width == 0) or (height == 0)
+        # scale -> scaled holder
+        self.scaled_holders = {}
         if self.no_image:
             self.image = None
             self.mask = None
+            self.sprite = None
+            self.alpha_inv = None
         else:
-            self.image = PIL.Image.frombytes(
-                'RGBX', self.size, 
-                base64.b64decode(str_image.encode('utf-8'))
+            self.set_images(
+                PIL.Image.frombytes(
+                    'RGBX', self.size, 
+                    base64.b64decode(str_image.encode('utf-8'))
+                ),
+                PIL.Image.frombytes(
+                    '1', self.size, 
+                    base64.b64decode(str_mask.encode('utf-8'))
+                ),
             )
-            self.mask = PIL.Image.frombytes(
-                '1', self.size, 
-                base64.b64decode(str_mask.encode('utf-8'))
+    
+    def set_images(self, image, mask):
+        
+        self.image = image
+        self.mask = mask
+        # premultiplied sprite: rgb * alpha and 255 - alpha
+        rgb = np.asarray(image.convert('RGB'), dtype=np.uint32)
+        alpha = np.asarray(mask.convert('L'), dtype=np.uint32)[:, :, None]
+        self.sprite = (rgb * alpha + 127) // 255
+        self.alpha_inv = 255 - alpha
+    
+    def scaled(self, scale):
+        """Returns the cursor for a screen scaled by scale.
+        The mask is resized as a grayscale image, so the edge of a scaled cursor is blended."""
+        
+        if scale == 1 or self.no_image:
+            return self
+        
+        holder = self.scaled_holders.get(scale)
+        if holder is None:
+            holder = CursorHolder(
+                round(self.ox * scale), round(self.oy * scale), 0, 0, None, None)
+            holder.args = self.args
+            holder.size = tuple(max(1, round(x * scale)) for x in self.size)
+            holder.no_image = False
+            holder.set_images(
+                self.image.convert('RGB').resize(holder.size, PIL.Image.BILINEAR),
+                self.mask.convert('L').resize(holder.size, PIL.Image.BILINEAR),
             )
+            self.scaled_holders[scale] = holder
+        return holder
+    
+    def paste_into(self, screen, position):
+        """Blends the cursor into an RGB screen in place.
+        Only the region under the cursor is read and written."""
         
+        if self.no_image:
+            return screen
+        
+        x, y = position[0] - self.ox, position[1] - self.oy
+        box = (x, y, x + self.size[0], y + self.size[1])
+        region = np.asarray(screen.crop(box), dtype=np.uint32)
+        blended = self.sprite + (region * self.alpha_inv + 127) // 255
+        screen.paste(PIL.Image.fromarray(blended.astype(np.uint8), 'RGB'), box)
+        return screen
+    
     def draw(self, screen, position):
         
-        output = screen.copy()
-        if not self.no_image:
-            p = (position[0] - self.ox, position[1] - self.oy)
-            output.paste(self.image, p, self.mask)
-        return output
+        return self.paste_into(screen.copy(), position)
     
     def __repr__(self):
         
         return f'cursor_holder({self.no_image}, {self.size})'
     
 
+class CursorTable(object):
+    """Cursors of a record keyed by their hashes (cursors.txt).
+    Each cursor is decoded once and the holder is shared by the events referring to it.
+    Old records have the cursor args in events instead of keys."""
+    
+    def __init__(self, entries=None):
+        
+        self.entries = {} if entries is None else entries
+        self.holders = {}
+    
+    @classmethod
+    def read(cls, file_path):
+        
+        if not os.path.exists(file_path):
+            return cls()
+        return cls({e['key']: e['args'] for e in RecordData.read_jsonl(file_path)})
+    
+    def get(self, args):
+        """Returns a CursorHolder for the args of a cursor event"""
+        
+        if len(args) != 1:
+            return CursorHolder.get(*args)
+        
+        key = args[0]
+        holder = self.holders.get(key)
+        if holder is None:
+            if key in self.entries:
+                holder = CursorHolder.get(*self.entries[key])
+            else:
+                print(f'unknown cursor: {key}')
+                holder = CursorHolder(0, 0, 0, 0, None, None)
+            self.holders[key] = holder
+        return holder
+
+
 class CursorEvent(EventBase):
     
+    __slots__ = ('cursor_args', 'cursor')
+    
     name = 'cursor'
     repr_props = ('cursor',)
     
-    def __init__(self, time_abs, time_origin_abs, args):
+    def set_args(self, args):
+        
+        # a key of the cursor table or the cursor args of old records
+        self.cursor_args = args
+    
+    @property
+    def args(self):
+        
+        return self.cursor_args
+    
+    def __init__(self, time_abs, time_origin_abs, args, cursor_table=None):
         
         super().__init__(time_abs, time_origin_abs, args)
-        self.cursor = CursorHolder(*args)
+        if cursor_table is None:
+            cursor_table = CursorTable()
+        self.cursor = cursor_table.get(args)
 
 
 class ImageEvent(EventBase):
     
+    __slots__ = ('path',)
+    
     name = 'image'
     repr_props = ('basename',)
-    
-    @property
-    def path(self):
-        
-        return self.args[0]
+    arg_names = ('path',)
     
     @property
     def basename(self):
         
-        return os.path.basename(self.args[0])
+        return os.path.basename(self.path)
     
     @property
     def screen(self):
@@ -279,100 +457,127 @@ class ImageEvent(EventBase):
 
 class PointerEvent(EventBase):
     
+    __slots__ = ('x', 'y', 'button_mask')
+    
     name = 'pointer'
     repr_props = ('xy', 'button_mask')
-    
-    @property
-    def x(self):
-        
-        return self.args[0]
-    
-    @property
-    def y(self):
-        
-        return self.args[1]
+    arg_names = ('x', 'y', 'button_mask')
     
     @property
     def xy(self):
         
         return (self.x, self.y)
-    
-    @property
-    def button_mask(self):
-        
-        return self.args[2]
 
 
 class KeyEvent(EventBase):
 
+    __slots__ = ('key_id', 'key_mask')
+    
     name = 'key'
     repr_props = ('key_id', 'physical_key', 'logical_key', 'key_mask')
+    arg_names = ('key_id', 'key_mask')
     key_layout = LAYOUT_US_STANDARD
     
-    @property
-    def key_id(self):
-        
-        return self.args[0]
-    
     @property
     def logical_key(self):
         
-        s = SPECIAL_KEYS_REV.get(self.args[0], None)
+        s = SPECIAL_KEYS_REV.get(self.key_id, None)
         if s is None:
-            s = chr(self.args[0])
+            s = chr(self.key_id)
         return s
     
     @property
     def physical_key(self):
         
-        s = SPECIAL_KEYS_REV.get(self.args[0], None)
+        s = SPECIAL_KEYS_REV.get(self.key_id, None)
         if s is None:
-            s = chr(self.args[0])
+            s = chr(self.key_id)
             s = self.key_layout.get(s, s)
         return s
-    
-    @property
-    def key_mask(self):
-        
-        return self.args[1]
 
 
 # A virtual event
 class ButtonEvent(EventBase):
 
+    __slots__ = ('x', 'y', 'button_id', 'event_type')
+    
     name = 'button'
     repr_props = ('button_id', 'event_type')
+    arg_names = ('x', 'y', 'button_id', 'event_type')
     
     @property
-    def x(self):
+    def xy(self):
         
-        return self.args[0]
+        return (self.x, self.y)
+
+
+# Columnar events
+# Sessions have tens of thousands of pointer events.
+# They are held as numpy arrays and event objects are made only when accessed.
+class EventColumns(object):
+    """Events of a class as columns: time_abs, time_rel and an int64 array for each arg.
+    The arg names are given by event_class.arg_names."""
     
-    @property
-    def y(self):
+    def __init__(self, event_class, time_abs, time_origin_abs, args):
+        """time_abs: an array of shape (n,), args: an array of shape (n, number of args)"""
         
-        return self.args[1]
+        self.event_class = event_class
+        self.time_origin_abs = time_origin_abs
+        self.time_abs = np.asarray(time_abs, dtype=np.float64)
+        self.time_rel = self.time_abs - time_origin_abs
+        self.args = np.asarray(args, dtype=np.int64).reshape(len(self.time_abs), len(event_class.arg_names))
+        for k, name in enumerate(event_class.arg_names):
+            setattr(self, name, self.args[:, k])
     
-    @property
-    def xy(self):
+    @classmethod
+    def from_raw_events(cls, event_class, raw_events, time_origin_abs):
+        """Makes columns from a list of dicts with time and args (the event log form)"""
+        
+        return cls(
+            event_class,
+            [ev['time'] for ev in raw_events],
+            time_origin_abs,
+            [ev['args'] for ev in raw_events],
+        )
+    
+    def __len__(self):
         
-        return (self.x, self.y)
+        return len(self.time_abs)
     
-    @property
-    def button_id(self):
+    def __getitem__(self, i):
         
-        return self.args[2]
+        return self.event_class(
+            float(self.time_abs[i]), 
+            self.time_origin_abs, 
+            self.args[i].tolist(),
+        )
     
-    @property
-    def event_type(self):
+    def __iter__(self):
+        
+        for i in range(len(self)):
+            yield self[i]
+    
+    def take(self, ids):
+        """Returns new columns with the events of the given ids"""
+        
+        return EventColumns(self.event_class, self.time_abs[ids], self.time_origin_abs, self.args[ids])
+    
+    def sorted(self):
         
-        return self.args[3]
+        return self.take(np.argsort(self.time_abs, kind='stable'))
+    
+    def __repr__(self):
+        
+        return f'EventColumns({self.event_class.name}, {len(self)})'
 
 
 # Utility for interval
 class Interval(object):
     """Holds a timestamp, input and actions for an interval"""
     
+    __slots__ = (
+        'ge', 'lt', 'image', 'xy', 'key_event', 'button_event', 'cursor_event', 'control_events')
+    
     def __init__(self, ge, lt):
         
         # timestamp
@@ -414,60 +619,29 @@ class Intervals(object):
         """
         
         self.boundaries = sorted(boundaries)
+        self.boundary_array = np.asarray(self.boundaries, dtype=np.float64)
         
         self.intervals = []
         last_lt = -float('inf')
         for lt in self.boundaries + [+float('inf')]:
             self.intervals.append(Interval(last_lt, lt))
             last_lt = lt
-        
-        self.finit_first_end = self.intervals[0].lt
-        self.finit_last_end = self.intervals[-1].ge
-        
-        self.average_length = 1
-        if len(self.intervals) >= 3:
-            length = self.finit_last_end - self.finit_first_end
-            self.average_length = length / (len(self.intervals) - 2)
     
     def __len__(self):
         """Returns the number of intervals in this class"""
         
         return len(self.intervals)
     
-    def get_id(self, t):
-        """Returns the corresponding interval id to the given float value t.
-        None will be returned if t is greater than the last end of the intervals.
-        """
-        
-        num_intervals = len(self.intervals)
-        
-        if num_intervals == 1:
-            return 0
-        
-        if num_intervals == 2:
-            return 0 if t < self.finit_first_end else 1
+    def get_ids(self, ts):
+        """Returns the corresponding interval ids to an array of float values.
+        The id of t is the number of boundaries less than or equal to t."""
         
-        if t >= self.finit_last_end:
-            return num_intervals - 1
-        
-        i = round(t / self.average_length)
-        i = max(1, min(i, num_intervals - 2))
-        
-        while True:
-            # boundaries for the interval i
-            ge_i = self.boundaries[i-1]
-            lt_i = self.boundaries[i]
-            if ge_i <= t and t < lt_i: 
-                return i
-            elif ge_i > t:
-                i -= 1
-                if i == 0:
-                    return i
-            else:
-                # means t >= lt_i:
-                i += 1
+        return np.searchsorted(self.boundary_array, ts, side='right')
+    
+    def get_id(self, t):
+        """Returns the corresponding interval id to the given float value t."""
         
-        return i
+        return int(self.get_ids(t))
     
     def __getitem__(self, ids):
         
@@ -490,62 +664,96 @@ class Intervals(object):
         
         return [get_single(i) for i in ids]
     
+    @staticmethod
+    def shift_ids(ids):
+        """Shifts sorted interval ids to the previous intervals so that each interval has at most an id.
+        Scanning from the last, the k-th id goes to s_k = min(ids[k], s_{k+1} - 1).
+        This is s_k = k + min_{j >= k}(ids[j] - j), a suffix minimum.
+        Negative ids mean that the objects are dropped."""
+        
+        if len(ids) == 0:
+            return ids
+        order = np.arange(len(ids))
+        suffix_min = np.minimum.accumulate((ids - order)[::-1])[::-1]
+        return order + suffix_min
+    
     def set_objects(self, objects, object_name, shift=True, take='first'):
+        """objects: a list of events, a list of dicts with time_rel and obj, or EventColumns"""
         
-        assert not (shift and take == 'all'), 'not supported the combination of shfit and take_all'
+        if len(objects) == 0:
+            return
         
-        # decide the type of objects: dict or event list 
-        use_dict = False
-        try:
-            if 'time_rel' in objects[0] and 'obj' in objects[1]:
-                use_dict = True
-        except:
-            pass
-        
-        interval_objects = [[] for _ in range(len(self.intervals))]
-        if use_dict:
-            for obj in objects:
-                i = self.get_id(obj['time_rel'])
-                interval_objects[i].append(obj['obj'])
+        # decide the type of objects: columns, dict or event list 
+        if isinstance(objects, EventColumns):
+            self.set_values(objects.time_rel, objects.__getitem__, object_name, shift, take)
+        elif isinstance(objects[0], dict):
+            times = np.fromiter((obj['time_rel'] for obj in objects), np.float64, len(objects))
+            self.set_values(times, [obj['obj'] for obj in objects].__getitem__, object_name, shift, take)
         else:
-            for obj in objects:
-                i = self.get_id(obj.time_rel)
-                interval_objects[i].append(obj)
-            
+            times = np.fromiter((obj.time_rel for obj in objects), np.float64, len(objects))
+            self.set_values(times, objects.__getitem__, object_name, shift, take)
+    
+    def set_values(self, times, get_value, object_name, shift=True, take='first'):
+        """Sets values to the intervals that the times belong to.
+        get_value(k) returns the k-th value, and it is called only for the values set."""
+        
+        assert not (shift and take == 'all'), 'not supported the combination of shfit and take_all'
+        
+        if len(times) == 0:
+            return
+        
+        # values ordered by (interval id, input order)
+        ids = self.get_ids(times)
+        order = np.argsort(ids, kind='stable')
+        ids = ids[order]
+        
         # Shift events to the previous steps so that each interval has at most an event.
         # We need this process because our model can handle just an event at an interval.
         # We choose this method to keep causarity.
         if shift:
-            for i in reversed(range(len(interval_objects))):
-                if len(interval_objects[i]) > 1:
-                    if i != 0:
-                        interval_objects[i-1] += interval_objects[i][:-1]
-                    interval_objects[i] = [interval_objects[i][-1]]
-        
-        for i in range(len(interval_objects)):
-            if interval_objects[i]:
-                val = interval_objects[i]
-                if take == 'first':
-                    val = val[0]
-                elif take == 'last':
-                    val = val[-1]
-                setattr(self.intervals[i], object_name, val)
+            ids = self.shift_ids(ids)
+            valid = ids >= 0
+            ids = ids[valid]
+            order = order[valid]
+        
+        if take == 'all':
+            starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+            ends = np.r_[starts[1:], len(ids)]
+            for start, end in zip(starts.tolist(), ends.tolist()):
+                val = [get_value(k) for k in order[start:end].tolist()]
+                setattr(self.intervals[ids[start]], object_name, val)
+            return
+        
+        if take == 'first':
+            picked = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+        else:
+            picked = np.flatnonzero(np.r_[ids[1:] != ids[:-1], True])
+        
+        for i, k in zip(ids[picked].tolist(), order[picked].tolist()):
+            setattr(self.intervals[i], object_name, get_value(k))
     
     def set_defaults_with_neighbors(self, object_name, backward_first=True):
+        """Fills None with the nearest item in the next intervals (backward_first) 
+        or in the previous intervals, then with the nearest item in the other direction."""
+        
+        items = [getattr(interval, object_name) for interval in self.intervals]
+        n = len(items)
+        order = np.arange(n)
+        has_item = np.fromiter((item is not None for item in items), bool, n)
+        
+        # the nearest ids with items: n or -1 if not found
+        next_ids = np.minimum.accumulate(np.where(has_item, order, n)[::-1])[::-1]
+        prev_ids = np.maximum.accumulate(np.where(has_item, order, -1))
         
         if backward_first:
-            preprocesses = (reversed, lambda x:x)
+            source_ids = np.where(next_ids < n, next_ids, prev_ids)
         else:
-            preprocesses = (lambda x:x, reversed)
-        
-        for pp in preprocesses:
-            last_item = None
-            for interval in pp(self.intervals):
-                item = getattr(interval, object_name)
-                if item is None:
-                    setattr(interval, object_name, last_item)
-                else:
-                    last_item = item
+            source_ids = np.where(prev_ids >= 0, prev_ids, next_ids)
+        
+        for i in np.flatnonzero(~has_item).tolist():
+            j = int(source_ids[i])
+            if 0 <= j < n:
+                setattr(self.intervals[i], object_name, items[j])
     
 
 # Utility for recorded data
@@ -568,12 +776,36 @@ class RecordData(object):
         
         return (not name.startswith('.')) and name.endswith('.jpg')
     
+    @staticmethod
+    def is_marker_file(name):
+        """Defines marker files that refer to a previous image file.
+        The recorder writes them instead of images when the screen is not changed."""
+        
+        return (not name.startswith('.')) and name.endswith('.ref')
+    
+    @staticmethod
+    def read_marker(file_path):
+        """Returns the name of the image file that a marker refers to"""
+        
+        with open(file_path) as f:
+            return f.read().strip()
+    
     @staticmethod    
     def read_jsonl(file_path):
-        """Reads a jsonl file"""    
+        """Reads a jsonl file.
+        An incomplete last line, left by a crash during writing, is ignored."""    
         
         with open(file_path) as f:
-            return [json.loads(line) for line in f.readlines()]
+            lines = f.readlines()
+        
+        if lines and not lines[-1].endswith('\n'):
+            try:
+                json.loads(lines[-1])
+            except ValueError:
+                print(f'incomplete last line was ignored: {file_path}')
+                lines.pop()
+        
+        return [json.loads(line) for line in lines]
     
     @staticmethod
     def pop_events_by_names(events, names):
@@ -582,43 +814,134 @@ class RecordData(object):
         
         if isinstance(names, str):
             names = [names]
+        names = set(names)
         
         popped_events = []
-        for i in reversed(range(len(events))):
-            if events[i].name in names:
-                popped_events.append(events.pop(i))
-        popped_events = list(reversed(popped_events))
+        remained_events = []
+        for ev in events:
+            if ev.name in names:
+                popped_events.append(ev)
+            else:
+                remained_events.append(ev)
+        events[:] = remained_events
         
         return popped_events, events
     
+    @staticmethod
+    def partition_events(events, names):
+        """Buckets events by names in a single pass.
+        Returns a dict of name -> events and a list of the other events. 
+        The order of the events is kept in each list."""
+        
+        buckets = {name: [] for name in names}
+        others = []
+        for ev in events:
+            bucket = buckets.get(ev.name)
+            if bucket is None:
+                others.append(ev)
+            else:
+                bucket.append(ev)
+        
+        return buckets, others
+    
     @classmethod
-    def make_event_objects(cls, raw_event_list, time_abs_min):
+    def make_event_objects(cls, raw_event_list, time_abs_min, cursor_table=None):
         """Obtains a list of event objects from a list of dict objects"""
         
         return [cls.event_by_name[ev['event']](
                 time_abs=ev['time'],
                 time_origin_abs=time_abs_min,
                 args=ev['args'],
+                cursor_table=cursor_table,
             ) for ev in raw_event_list]
     
+    @staticmethod
+    def get_event_log_path(base_dir):
+        """Returns the path of the event log. The binary log is used if a record has it."""
+        
+        path = os.path.join(base_dir, eventlog.BINARY_FILE_NAME)
+        if not os.path.exists(path):
+            path = os.path.join(base_dir, eventlog.JSONL_FILE_NAME)
+        return path
+    
+    @staticmethod
+    def iter_raw_events(file_path):
+        """Yields the events of an event log one by one as dicts with time, event and args"""
+        
+        if file_path.endswith('.bin'):
+            with open(file_path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    # an empty log (e.g. a crash before the first flush) has no events
+                    return
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for t, event, args in eventlog.iter_binary_events(buffer):
+                        yield {'time': t, 'event': event, 'args': args}
+                finally:
+                    buffer.close()
+            return
+        
+        with open(file_path) as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    try:
+                        json.loads(line)
+                    except ValueError:
+                        print(f'incomplete last line was ignored: {file_path}')
+                        break
+                yield json.loads(line)
+    
     @classmethod
-    def get_image_events(cls, base_dir, base_interval):
-        """Obtains a list of image events, sorted by time, from a directory"""
+    def list_image_files(cls, base_dir):
+        """Returns a list of (time_abs, path) of the images in a directory, not sorted.
+        A marker shares the path of the referred image.
+        The index of the record is used if it exists, so the directory is not listed.
+        If the index is incomplete (the recording is running or crashed),
+        only the files after the indexed frames are parsed."""
+        
+        index = record_index.read_index(base_dir)
+        images = []
+        time_indexed = None
+        if index is not None:
+            images = [(t, os.path.join(base_dir, name)) for t, name in index['frames']]
+            if index['complete']:
+                return images
+            time_indexed = index['time_max']
         
         re_timestamp = re.compile('[.0-9]*[0-9]')
         
-        events = []
-        for name in os.listdir(base_dir):
+        names = set(os.listdir(base_dir))
+        
+        for name in names:
+            
+            is_image = cls.is_acceptable_image_file(name)
+            is_marker = cls.is_marker_file(name)
             
-            if cls.is_acceptable_image_file(name):
+            if is_image or is_marker:
                 
                 m = re_timestamp.findall(name)
                 if len(m) == 1:
                     
                     time_abs = float(m[0])
+                    if time_indexed is not None and time_abs <= time_indexed:
+                        continue
                     path = os.path.join(base_dir, name)
-                    events.append({'time': time_abs, 'event': 'image', 'args': [path]})
+                    if is_marker:
+                        # an image event of a marker shares the path of the referred image
+                        ref_name = cls.read_marker(path)
+                        if ref_name not in names:
+                            continue
+                        path = os.path.join(base_dir, ref_name)
+                    images.append((time_abs, path))
         
+        return images
+    
+    @classmethod
+    def get_image_events(cls, base_dir, base_interval):
+        """Obtains a list of image events, sorted by time, from a directory"""
+        
+        events = [{'time': time_abs, 'event': 'image', 'args': [path]} 
+                  for time_abs, path in cls.list_image_files(base_dir)]
         events.sort(key=lambda ev:ev['time'])
         time_abs_min = events[0]['time']
         
@@ -661,74 +984,103 @@ class RecordData(object):
     def split_masks(cls, x):
         return [bool(x & (1 << k)) for k in range(cls.num_buttons)]
     
+    @classmethod
+    def to_pointer_columns(cls, pointer_events):
+        
+        if isinstance(pointer_events, EventColumns):
+            return pointer_events
+        return EventColumns(
+            PointerEvent, 
+            [ev.time_abs for ev in pointer_events], 
+            pointer_events[0].time_origin_abs if pointer_events else 0.0,
+            [ev.args for ev in pointer_events],
+        )
+    
     @classmethod
     def obtain_click_up_down_events(cls, pointer_events, unification_interval=None):
         """Returns event list.
+        pointer_events is EventColumns or a list of pointer events.
         Each element is a dict with the following keys.
             - time_rel: timestamp for this event
             - obj:
                 - event_type: event type in {click, up, down}
                 - bid: related button mask in {0, 1, ..., num_buttons-1}
                 - xy: the cursor position (x, y) 
+        Button events are found with bit operations over the button mask column.
         """
         
-        make_event = lambda ev, bid, event_type: {
-                'time_rel': ev.time_rel,
-                'obj': ButtonEvent(
-                    ev.time_abs, 
-                    ev.time_origin_abs, 
-                    [ev.x, ev.y, bid, event_type]
-                )
-        }
+        pointer_events = cls.to_pointer_columns(pointer_events)
+        n = len(pointer_events)
         
-        if unification_interval is not None:
-            is_continuous = lambda ev1, ev2: abs(ev2.time_rel - ev1.time_rel) <= unification_interval
-        else:
-            is_continuous = True
+        time_abs = pointer_events.time_abs.tolist()
+        time_rel = pointer_events.time_rel.tolist()
+        xs = pointer_events.x.tolist()
+        ys = pointer_events.y.tolist()
+        time_origin_abs = pointer_events.time_origin_abs
         
         button_events = [[] for _ in range(cls.num_buttons)]
-        waiting_decision = [False] * cls.num_buttons
-        
-        last_ev = pointer_events[0]
-        last_masks = cls.split_masks(pointer_events[0].button_mask)
         
-        for i in range(1, len(pointer_events)):
-        
-            ev = pointer_events[i]
-            masks = cls.split_masks(ev.button_mask)
-        
-            for bid, (l, lm) in enumerate(zip(masks, last_masks)):
-                
-                if l != lm:
-                    if l:
-                        # changed to down
-                        waiting_decision[bid] = True
-                    else:
-                        # changed to up
-                        if waiting_decision[bid]:
-                            if is_continuous(last_ev, ev):
-                                # issue click
-                                button_events[bid].append(make_event(last_ev, bid, 'click'))
-                            else:
-                                # issue down and up
-                                button_events[bid].append(make_event(last_ev, bid, 'down'))
-                                button_events[bid].append(make_event(ev, bid, 'up'))
-                        else:
-                            # issue up
-                            button_events[bid].append(make_event(ev, bid, 'up'))
-                        
-                        waiting_decision[bid] = False
-                else:
-                    if l:
-                        # keeping down
-                        if waiting_decision[bid]:
-                            # issue down
-                            button_events[bid].append(make_event(last_ev, bid, 'down'))
-                    
-                    waiting_decision[bid] = False      
+        if n >= 2:
+            # bits[i, bid]: the button bid is down at the i-th pointer event
+            bits = (pointer_events.button_mask[:, None] >> np.arange(cls.num_buttons)) & 1
+            
+            # row s is the step from the s-th event to the (s+1)-th event
+            prev, cur = bits[:-1], bits[1:]
+            down = (cur == 1) & (prev == 0)
+            up = (cur == 0) & (prev == 1)
+            held = (cur == 1) & (prev == 1)
+            
+            # a change to down waits for the decision at the next step
+            waiting = np.zeros_like(down)
+            waiting[1:] = down[:-1]
+            
+            if unification_interval is not None:
+                continuous = (np.abs(np.diff(pointer_events.time_rel)) <= unification_interval)[:, None]
+            else:
+                continuous = np.ones((n - 1, 1), dtype=bool)
             
-            last_ev = ev
-            last_masks = masks
+            # up after down: a click at the previous event, or down and up if they are far
+            click = up & waiting & continuous
+            separated = up & waiting & ~continuous
+            # up after a long press
+            single_up = up & ~waiting
+            # keeping down after down: a down at the previous event
+            long_down = held & waiting
+            
+            event_types = ('click', 'down', 'up')
+            for bid in range(cls.num_buttons):
+                
+                # (order, event index, type id) of each button event
+                # the order of a step s is 2 * s, and an up following a down in the same step is 2 * s + 1
+                parts = []
+                for condition, offset, event_offset, type_id in (
+                        (click, 0, 0, 0),
+                        (separated, 0, 0, 1),
+                        (separated, 1, 1, 2),
+                        (single_up, 0, 1, 2),
+                        (long_down, 0, 0, 1)):
+                    steps = np.flatnonzero(condition[:, bid])
+                    if len(steps):
+                        parts.append(np.stack([
+                            2 * steps + offset, 
+                            steps + event_offset, 
+                            np.full(len(steps), type_id),
+                        ], axis=1))
+                
+                if not parts:
+                    continue
+                entries = np.concatenate(parts)
+                entries = entries[np.argsort(entries[:, 0], kind='stable')]
+                
+                for _, i, type_id in entries.tolist():
+                    button_events[bid].append({
+                        'time_rel': time_rel[i],
+                        'obj': ButtonEvent(
+                            time_abs[i], 
+                            time_origin_abs, 
+                            [xs[i], ys[i], bid, event_types[type_id]]
+                        )
+                    })
         
         if unification_interval is not None:
             return cls.unify_clicks(button_events, unification_interval)
@@ -736,44 +1088,45 @@ class RecordData(object):
     
     @classmethod
     def unify_clicks(cls, event_list, interval):
-    
+        """Unifies clicks into double and triple clicks.
+        A click and at most 2 following clicks within interval from it are unified.
+        Events are scanned once by index."""
+        
         is_continuous_click = lambda ev, next_ev: \
-            (next_ev is not None) and \
             (abs(next_ev['time_rel'] - ev['time_rel']) <= interval) and \
             (next_ev['obj'].event_type == 'click')
         
         unified_event_list = []
-    
+        
         for bid, _list in enumerate(event_list):
-            _list.append(None)
-            ev = _list.pop(0)
-            while ev is not None:
+            n = len(_list)
+            k = 0
+            while k < n:
+                ev = _list[k]
                 if ev['obj'].event_type == 'click':
-                    event_type = cls.click_types[-1]
-                    for i, event_type in enumerate(cls.click_types):
-                        next_ev = _list.pop(0)
-                        if not is_continuous_click(ev, next_ev):
-                            event_type = event_type
-                            break
+                    count = 1
+                    while count < len(cls.click_types) and k + count < n and \
+                            is_continuous_click(ev, _list[k + count]):
+                        count += 1
                     unified_event_list.append({
                         'time_rel': ev['time_rel'],
                         'obj': ButtonEvent(
                             ev['obj'].time_abs, 
                             ev['obj'].time_origin_abs, 
-                            [ev['obj'].x, ev['obj'].y, bid, event_type]
+                            [ev['obj'].x, ev['obj'].y, bid, cls.click_types[count - 1]]
                         )
                     })
-                    ev = next_ev
+                    k += count
                 else:
                     unified_event_list.append(ev)
-                    ev = _list.pop(0)
-    
+                    k += 1
+        
         return unified_event_list
     
     def set_basic_properties(self, base_dir, base_interval, image_event_list):
         
         self.base_dir = base_dir
-        self.event_log_path = os.path.join(base_dir, 'events.txt')
+        self.event_log_path = self.get_event_log_path(base_dir)
         self.base_interval = base_interval
         
         # We assume that image events have been sorted
@@ -782,17 +1135,62 @@ class RecordData(object):
         self.time_elapsed = self.time_abs_max - self.time_abs_min
         
         self.base_image_path = image_event_list[0].path
-        base_image = PIL.Image.open(self.base_image_path)
-        self.image_size = base_image.size
-        base_image.close()
+        self.image_size = self.get_image_size(base_dir, self.base_image_path)
+    
+    @staticmethod
+    def get_image_size(base_dir, image_path):
+        """Returns the size of the images in a record from the summary of the index, or by opening an image"""
+        
+        summary = record_index.read_summary(base_dir)
+        if summary is not None and summary['image_size']:
+            return tuple(summary['image_size'])
+        
+        image = PIL.Image.open(image_path)
+        size = image.size
+        image.close()
+        return size
+    
+    def get_raw_events(self):
+        
+        if self.event_log_path.endswith('.bin'):
+            return eventlog.read_binary_events(self.event_log_path)
+        return self.read_jsonl(self.event_log_path)
+    
+    def get_cursor_table(self):
+        
+        return CursorTable.read(os.path.join(self.base_dir, eventlog.CURSOR_FILE_NAME))
     
     def get_extended_events(self):
         
         return self.make_event_objects(
-            raw_event_list=self.read_jsonl(self.event_log_path),
+            raw_event_list=self.get_raw_events(),
             time_abs_min=self.time_abs_min,
+            cursor_table=self.get_cursor_table(),
         )
     
+    def get_extended_event_columns(self):
+        """Returns key and pointer events as EventColumns and a list of the other event objects.
+        Objects are not made for key and pointer events."""
+        
+        raw_events = {'key': [], 'pointer': []}
+        other_raw_events = []
+        for ev in self.get_raw_events():
+            bucket = raw_events.get(ev['event'])
+            if bucket is None:
+                other_raw_events.append(ev)
+            else:
+                bucket.append(ev)
+        
+        key_columns = EventColumns.from_raw_events(KeyEvent, raw_events['key'], self.time_abs_min)
+        pointer_columns = EventColumns.from_raw_events(PointerEvent, raw_events['pointer'], self.time_abs_min)
+        
+        other_events = self.make_event_objects(
+            raw_event_list=other_raw_events,
+            time_abs_min=self.time_abs_min,
+            cursor_table=self.get_cursor_table(),
+        )
+        return key_columns, pointer_columns, other_events
+    
     def read_from_dir(self, base_dir, base_interval, click_max_interval=1/3):
         
         # Obtain image events from a directory
@@ -802,11 +1200,10 @@ class RecordData(object):
         self.set_basic_properties(base_dir, base_interval, image_events)
         
         # Obtain other events than image events
-        remained_events = self.get_extended_events()
-        key_events, remained_events = self.pop_events_by_names(remained_events, 'key')
-        pointer_events, remained_events = self.pop_events_by_names(remained_events, 'pointer')
-        cursor_events, remained_events = self.pop_events_by_names(remained_events, 'cursor')
-        control_events = remained_events
+        # key and pointer events are columns
+        key_events, pointer_events, remained_events = self.get_extended_event_columns()
+        buckets, control_events = self.partition_events(remained_events, ('cursor',))
+        cursor_events = buckets['cursor']
         
         # Add objects to the intervals
         self.intervals = Intervals([ev.time_rel for ev in image_events])
@@ -819,8 +1216,9 @@ class RecordData(object):
         # we consider mouse down and up event closer to 2 intervals as click
         button_events = self.obtain_click_up_down_events(pointer_events, unification_interval=click_max_interval)
         self.intervals.set_objects(button_events, 'button_event', shift=True, take='last')
-        self.intervals.set_objects(
-            [{'time_rel':ev.time_rel, 'obj':ev.xy} for ev in pointer_events], 
+        self.intervals.set_values(
+            pointer_events.time_rel,
+            lambda k: (int(pointer_events.x[k]), int(pointer_events.y[k])),
             'xy', 
             shift=False,
             take='last',
@@ -841,8 +1239,8 @@ class RecordData(object):
         
         # Set event data to the instance
         self.image_events = image_events
-        self.key_events = sorted(key_events, key=lambda ev:ev.time_abs)
-        self.pointer_events = sorted(pointer_events, key=lambda ev:ev.time_abs)
+        self.key_events = key_events.sorted()
+        self.pointer_events = pointer_events.sorted()
         self.cursor_events = sorted(cursor_events, key=lambda ev:ev.time_abs)
         self.control_events = sorted(control_events, key=lambda ev:ev.time_abs)
     
@@ -886,16 +1284,891 @@ class RecordData(object):
         return '\n'.join(lines)
 
 
-def serialize(input_path, output_path, base_interval):
+# Streaming reader
+# RecordData reads a whole record at once.
+# RecordStream gives the same intervals one by one reading the event log lazily.
+class ButtonEventDetector(object):
+    """Detects button events from pointer events given one by one.
+    The results are the same as RecordData.obtain_click_up_down_events (grouped by button).
+    A down waits for the next pointer event to decide a click and a click waits for the following clicks,
+    so events are returned when they are decided. A down is decided only by a pointer event as in RecordData,
+    and a down without a following pointer event is not returned. 
+    tick() tells the time of other events to return click groups held longer than hold_time."""
+    
+    def __init__(self, time_origin_abs, unification_interval=None, hold_time=10.0):
+        
+        self.time_origin_abs = time_origin_abs
+        self.unification_interval = unification_interval
+        self.hold_time = hold_time
+        
+        num_buttons = RecordData.num_buttons
+        self.waiting_decision = [False] * num_buttons
+        self.groups = [[] for _ in range(num_buttons)]
+        self.last = None
+        self.last_masks = None
+    
+    def make_event(self, ev, bid, event_type):
+        
+        return {
+            'time_rel': ev[0] - self.time_origin_abs,
+            'obj': ButtonEvent(ev[0], self.time_origin_abs, [ev[1], ev[2], bid, event_type]),
+        }
+    
+    def flush(self, bid):
+        """Returns the unified event of the click group of a button"""
+        
+        group = self.groups[bid]
+        if not group:
+            return []
+        self.groups[bid] = []
+        first = group[0]['obj']
+        return [(bid, {
+            'time_rel': group[0]['time_rel'],
+            'obj': ButtonEvent(first.time_abs, first.time_origin_abs, 
+                               [first.x, first.y, bid, RecordData.click_types[len(group) - 1]]),
+        })]
+    
+    def unify(self, bid, ev):
+        
+        if self.unification_interval is None:
+            return [(bid, ev)]
+        
+        group = self.groups[bid]
+        if group and ev['obj'].event_type == 'click' and \
+                abs(ev['time_rel'] - group[0]['time_rel']) <= self.unification_interval:
+            group.append(ev)
+            if len(group) == len(RecordData.click_types):
+                return self.flush(bid)
+            return []
+        
+        outputs = self.flush(bid)
+        if ev['obj'].event_type == 'click':
+            self.groups[bid] = [ev]
+        else:
+            outputs.append((bid, ev))
+        return outputs
+    
+    def push(self, time_abs, x, y, button_mask):
+        """Returns a list of (button id, event dict) decided by a pointer event"""
+        
+        ev = (time_abs, x, y)
+        masks = RecordData.split_masks(button_mask)
+        outputs = []
+        
+        if self.last is not None:
+            last = self.last
+            for bid, (l, lm) in enumerate(zip(masks, self.last_masks)):
+                if l != lm:
+                    if l:
+                        # changed to down
+                        self.waiting_decision[bid] = True
+                    else:
+                        # changed to up
+                        if self.waiting_decision[bid]:
+                            if self.unification_interval is None or \
+                                    abs(time_abs - last[0]) <= self.unification_interval:
+                                outputs += self.unify(bid, self.make_event(last, bid, 'click'))
+                            else:
+                                outputs += self.unify(bid, self.make_event(last, bid, 'down'))
+                                outputs += self.unify(bid, self.make_event(ev, bid, 'up'))
+                        else:
+                            outputs += self.unify(bid, self.make_event(ev, bid, 'up'))
+                        self.waiting_decision[bid] = False
+                else:
+                    if l and self.waiting_decision[bid]:
+                        # keeping down
+                        outputs += self.unify(bid, self.make_event(last, bid, 'down'))
+                    self.waiting_decision[bid] = False
+        
+        self.last = ev
+        self.last_masks = masks
+        
+        return outputs + self.tick(time_abs)
+    
+    def tick(self, time_abs):
+        """Returns events decided by the time. The log is assumed to be in time order."""
+        
+        outputs = []
+        if self.unification_interval is None:
+            return outputs
+        
+        time_rel = time_abs - self.time_origin_abs
+        for bid, group in enumerate(self.groups):
+            if group and time_rel - group[0]['time_rel'] > self.hold_time:
+                outputs += self.flush(bid)
+        return outputs
+    
+    def close(self):
+        
+        outputs = []
+        for bid in range(len(self.groups)):
+            outputs += self.flush(bid)
+        return outputs
+
+
+class RecordStream(object):
+    """Reads a record in time order and yields the intervals one by one.
+    The intervals are the same as RecordData.intervals.
+    
+    Events are held until the read events pass the end of their interval by lookahead seconds 
+    (plus click_max_interval). This covers the shift of key and button events and a disorder of the log. 
+    Events that would move further are dropped and counted.
+    A down is decided by the next pointer event as in RecordData, so it is also dropped if
+    the other events pass its interval by the window before the next pointer event comes.
+    Only timestamps of the images are held for the whole record. 
+    Intervals without xy are held until the next pointer event decides their xy,
+    but not longer than lookahead seconds. After that they take the last xy (None before 
+    the first pointer event) instead of the next one, so that a stretch without pointer events 
+    (e.g. typing) does not hold all the intervals in memory. 
+    In this case the xy differs from RecordData, where the next xy is taken.
+    """
+    
+    def __init__(self, base_dir, base_interval, click_max_interval=1/3, lookahead=10.0):
+        
+        self.base_dir = base_dir
+        self.base_interval = base_interval
+        self.click_max_interval = click_max_interval
+        self.lookahead = lookahead
+        self.event_log_path = RecordData.get_event_log_path(base_dir)
+        self.cursor_table = CursorTable.read(os.path.join(base_dir, eventlog.CURSOR_FILE_NAME))
+        
+        self.num_dropped = 0
+        # intervals that took the last xy because no pointer event came in lookahead
+        self.num_last_xy = 0
+        
+        self.read_image_timeline()
+    
+    def read_image_timeline(self):
+        """Fits images to the steps of base_interval like RecordData.fit_image_events
+        and assigns them to intervals. Only arrays of timestamps and image ids are kept."""
+        
+        images = sorted(RecordData.list_image_files(self.base_dir), key=lambda x:x[0])
+        self.image_paths = [path for _, path in images]
+        time_abs = np.array([t for t, _ in images], dtype=np.float64)
+        self.image_origin_abs = float(time_abs[0])
+        
+        # each step takes the last image in the step
+        steps = [RecordData._round((t - self.image_origin_abs) / self.base_interval) for t in time_abs.tolist()]
+        step_images = np.full(steps[-1] + 1, -1, dtype=np.int64)
+        for k, step in enumerate(steps):
+            step_images[step] = k
+        is_real = step_images >= 0
+        
+        # an empty step copies the image of the previous step
+        filled = np.maximum.accumulate(np.where(is_real, np.arange(len(step_images)), 0))
+        self.step_image_ids = step_images[filled]
+        self.step_time_abs = np.where(
+            is_real, 
+            time_abs[np.maximum(step_images, 0)], 
+            self.image_origin_abs + np.arange(len(step_images)) * self.base_interval,
+        )
+        step_time_rel = self.step_time_abs - self.image_origin_abs
+        
+        # the other events are relative to the first image kept, as in RecordData
+        self.time_abs_min = float(self.step_time_abs[0])
+        self.time_abs_max = float(self.step_time_abs[-1])
+        self.time_elapsed = self.time_abs_max - self.time_abs_min
+        print(f'image steps: {len(step_images)}, copied: {int((~is_real).sum())}, '
+              f'removed: {len(steps) - int(is_real.sum())}')
+        
+        # intervals and the first image step in each interval
+        self.boundaries = np.sort(step_time_rel)
+        ids = np.searchsorted(self.boundaries, step_time_rel, side='right')
+        self.interval_steps = np.full(len(self.boundaries) + 1, -1, dtype=np.int64)
+        self.interval_steps[ids[::-1]] = np.arange(len(ids))[::-1]
+        
+        self.image_size = RecordData.get_image_size(self.base_dir, self.image_paths[self.step_image_ids[0]])
+    
+    def __len__(self):
+        """Returns the number of intervals"""
+        
+        return len(self.boundaries) + 1
+    
+    def get_id(self, t):
+        
+        return int(np.searchsorted(self.boundaries, t, side='right'))
+    
+    def make_interval(self, i):
+        
+        ge = float(self.boundaries[i-1]) if i > 0 else -float('inf')
+        lt = float(self.boundaries[i]) if i < len(self.boundaries) else float('inf')
+        interval = Interval(ge, lt)
+        
+        step = int(self.interval_steps[i])
+        if step >= 0:
+            interval.image = ImageEvent(
+                float(self.step_time_abs[step]), 
+                self.image_origin_abs, 
+                [self.image_paths[self.step_image_ids[step]]],
+            )
+        return interval
+    
+    def pop_shifted(self, pending, i):
+        """Returns the object shifted to the interval i and removes the objects up to i from pending.
+        pending is a list of (interval id, order, object) as in Intervals.set_objects with shift.
+        Objects that have to go before i are dropped."""
+        
+        if not pending:
+            return None
+        
+        pending.sort(key=lambda x:(x[0], x[1]))
+        slots = Intervals.shift_ids(np.array([x[0] for x in pending], dtype=np.int64)).tolist()
+        
+        obj = None
+        num_removed = 0
+        for slot, entry in zip(slots, pending):
+            if slot > i:
+                break
+            if slot == i:
+                obj = entry[2]
+            elif slot >= 0:
+                # RecordData drops only the objects shifted before the first interval
+                self.num_dropped += 1
+            num_removed += 1
+        del pending[:num_removed]
+        return obj
+    
+    def iter_intervals(self):
+        
+        num_intervals = len(self)
+        window = self.lookahead + (self.click_max_interval or 0.0)
+        
+        # objects of the intervals not emitted yet: interval id -> object
+        xy_pointer = {}
+        xy_button = {}
+        cursor_events = {}
+        control_events = collections.defaultdict(list)
+        # objects to shift: (interval id, order, object)
+        key_pending = []
+        button_pending = []
+        button_seq = [0] * RecordData.num_buttons
+        key_seq = 0
+        
+        # intervals waiting for the next xy
+        waiting = collections.deque()
+        last_xy = None
+        next_id = 0
+        
+        def accept(i):
+            # objects of emitted intervals are dropped
+            if i < next_id:
+                self.num_dropped += 1
+                return False
+            return True
+        
+        def add_buttons(buttons):
+            for bid, ev in buttons:
+                i = self.get_id(ev['time_rel'])
+                if accept(i):
+                    # the same order as the list by unify_clicks
+                    order = (bid, button_seq[bid])
+                    button_seq[bid] += 1
+                    button_pending.append((i, order, ev['obj']))
+                    if i not in xy_button or xy_button[i][0] < order:
+                        xy_button[i] = (order, ev['obj'].xy)
+        
+        def emit(i):
+            nonlocal last_xy
+            
+            interval = self.make_interval(i)
+            interval.key_event = self.pop_shifted(key_pending, i)
+            interval.button_event = self.pop_shifted(button_pending, i)
+            interval.cursor_event = cursor_events.pop(i, None)
+            interval.control_events = control_events.pop(i, None)
+            
+            # xy of buttons overwrites xy of pointer events
+            xy = xy_pointer.pop(i, None)
+            if i in xy_button:
+                xy = xy_button.pop(i)[1]
+            
+            if xy is None:
+                waiting.append(interval)
+                return
+            
+            # the intervals without xy take the next xy
+            last_xy = xy
+            while waiting:
+                w = waiting.popleft()
+                w.xy = xy
+                yield w
+            interval.xy = xy
+            yield interval
+        
+        def emit_until(time_rel):
+            nonlocal next_id
+            while next_id < num_intervals:
+                lt = self.boundaries[next_id] if next_id < len(self.boundaries) else float('inf')
+                if lt + window > time_rel:
+                    break
+                next_id += 1
+                yield from emit(next_id - 1)
+        
+        def release_waiting(time_rel):
+            # the intervals that have waited for lookahead take the last xy
+            while waiting and waiting[0].lt + window + self.lookahead <= time_rel:
+                w = waiting.popleft()
+                w.xy = last_xy
+                self.num_last_xy += 1
+                yield w
+        
+        detector = ButtonEventDetector(self.time_abs_min, self.click_max_interval, self.lookahead)
+        frontier = -float('inf')
+        
+        for ev in RecordData.iter_raw_events(self.event_log_path):
+            
+            name = ev['event']
+            time_rel = ev['time'] - self.time_abs_min
+            
+            if name == 'pointer':
+                x, y, button_mask = ev['args']
+                i = self.get_id(time_rel)
+                if accept(i):
+                    xy_pointer[i] = (x, y)
+                add_buttons(detector.push(ev['time'], x, y, button_mask))
+            else:
+                i = self.get_id(time_rel)
+                if accept(i):
+                    if name == 'key':
+                        key_pending.append((i, key_seq, KeyEvent(ev['time'], self.time_abs_min, ev['args'])))
+                        key_seq += 1
+                    else:
+                        obj = RecordData.event_by_name[name](
+                            ev['time'], self.time_abs_min, ev['args'], cursor_table=self.cursor_table)
+                        if name == 'cursor':
+                            cursor_events[i] = obj
+                        else:
+                            control_events[i].append(obj)
+                add_buttons(detector.tick(ev['time']))
+            
+            frontier = max(frontier, time_rel)
+            yield from emit_until(frontier)
+            yield from release_waiting(frontier)
+        
+        add_buttons(detector.close())
+        yield from emit_until(float('inf'))
+        
+        # the last intervals without xy take the last xy
+        while waiting:
+            w = waiting.popleft()
+            w.xy = last_xy
+            yield w
+        
+        if self.num_dropped:
+            print(f'{self.num_dropped} events were dropped because they were out of lookahead')
+        if self.num_last_xy:
+            print(f'{self.num_last_xy} intervals took the last xy because no pointer event came in lookahead')
+    
+    def __iter__(self):
+        
+        return self.iter_intervals()
+
+
+class FrameTransform(object):
+    """Crops, resizes and converts frames in the conversion.
+    crop: a box (left, upper, right, lower) in the screen, or None for the whole screen
+    size: (width, height) of the output frames, or None for the size of the crop box
+    mode: 'RGB' or 'L' (grayscale)
+    image_format: 'JPEG', 'PNG' or 'WEBP', saved with quality (the default of PIL if None)
+    A JPEG source is decoded at a reduced scale in draft mode if the output is small enough, 
+    and the cursor is scaled with it."""
+    
+    modes = ('RGB', 'L')
+    extensions = {'JPEG': 'jpeg', 'PNG': 'png', 'WEBP': 'webp'}
+    
+    def __init__(self, size=None, crop=None, mode='RGB', image_format='JPEG', quality=None):
+        
+        assert mode in self.modes, f'unknown mode: {mode}'
+        assert image_format in self.extensions, f'unknown image format: {image_format}'
+        
+        self.size = tuple(size) if size else None
+        self.crop = tuple(crop) if crop else None
+        self.mode = mode
+        self.image_format = image_format
+        self.quality = quality
+    
+    @property
+    def extension(self):
+        
+        return self.extensions[self.image_format]
+    
+    @property
+    def is_identity(self):
+        """True if frames are the same as the source images"""
+        
+        return self.get_description() == FrameTransform().get_description()
+    
+    def get_description(self):
+        
+        return {
+            'size': list(self.size) if self.size else None,
+            'crop': list(self.crop) if self.crop else None,
+            'mode': self.mode,
+            'image_format': self.image_format,
+            'quality': self.quality,
+        }
+    
+    def open(self, image_path, screen_size):
+        """Opens a source image. Returns the image and its scale to the screen."""
+        
+        image = PIL.Image.open(image_path)
+        if self.size is None or image.format != 'JPEG':
+            return image, 1.0
+        
+        # the smallest screen that still gives the output size after cropping
+        crop = self.crop or (0, 0) + tuple(screen_size)
+        scale = max(self.size[0] / (crop[2] - crop[0]), self.size[1] / (crop[3] - crop[1]))
+        if scale >= 1.0:
+            return image, 1.0
+        image.draft('RGB', tuple(int(np.ceil(x * scale)) for x in screen_size))
+        return image, image.size[0] / screen_size[0]
     
-    record_data = RecordData(input_path, base_interval)
+    def apply(self, image, screen_size):
+        """Crops and resizes an image opened by open()"""
+        
+        if self.crop:
+            sx = image.size[0] / screen_size[0]
+            sy = image.size[1] / screen_size[1]
+            left, upper, right, lower = self.crop
+            image = image.crop((round(left * sx), round(upper * sy), round(right * sx), round(lower * sy)))
+        
+        if self.size and image.size != self.size:
+            image = image.resize(self.size, PIL.Image.BILINEAR)
+        
+        if image.mode != self.mode:
+            image = image.convert(self.mode)
+        return image
+    
+    def save(self, image, fp):
+        
+        options = {} if self.quality is None else {'quality': self.quality}
+        image.save(fp, format=self.image_format, **options)
+
+
+# Frame workers of serialize
+# The state is set by init_frame_worker in each worker process.
+frame_worker_state = {}
+
+
+def init_frame_worker(image_size, transform=None):
+    
+    frame_worker_state['image_size'] = image_size
+    frame_worker_state['transform'] = transform or FrameTransform()
+
+
+def render_frame(job):
+    """Composites the cursor on a frame, transforms and encodes it.
+    job is (source image path or None, raw args of the cursor or None, xy or None).
+    Returns the encoded bytes."""
+    
+    image_path, cursor_args, xy = job
+    screen_size = frame_worker_state['image_size']
+    transform = frame_worker_state['transform']
+    
+    if image_path is None:
+        image = PIL.Image.new('RGB', screen_size)
+    else:
+        image, scale = transform.open(image_path, screen_size)
+        if cursor_args is not None and xy:
+            # the image is opened here, so the cursor is drawn on it in place
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            cursor = CursorHolder.get(*cursor_args).scaled(scale)
+            cursor.paste_into(image, (round(xy[0] * scale), round(xy[1] * scale)))
+    image = transform.apply(image, screen_size)
+    
+    data = io.BytesIO()
+    transform.save(image, data)
+    return data.getvalue()
+
+
+def link_or_copy(src, dst):
+    """Makes dst a hardlink of src, or a copy if a hardlink is not possible"""
+    
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    
+    temp_file = dst + '.tmp'
+    if os.path.lexists(temp_file):
+        os.remove(temp_file)
+    try:
+        os.link(src, temp_file)
+    except OSError:
+        shutil.copyfile(src, temp_file)
+    os.replace(temp_file, dst)
+
+
+def get_content_key(data):
+    """Returns the key of an encoded frame in the frame stores"""
+    
+    return hashlib.sha1(data).hexdigest()
+
+
+class FrameFiles(object):
+    """Writes the frames of a converted record as {i}.jpeg files (or another extension).
+    Each distinct frame is stored once as blobs/ab/abcd....jpeg, named by the key of its bytes,
+    and {i}.jpeg is a hardlink (or a copy) of the blob.
+    serialize uses this and shard.ShardWriter in the same way."""
+    
+    def __init__(self, output_path, num_frames, extension='jpeg'):
+        
+        self.output_path = output_path
+        self.num_frames = num_frames
+        self.extension = extension
+        self.blob_path = os.path.join(output_path, BLOB_DIR_NAME)
+        # keys of the blobs referred by the frames
+        self.keys = set()
+    
+    @property
+    def num_blobs(self):
+        
+        return len(self.keys)
+    
+    def get_path(self, i):
+        
+        return os.path.join(self.output_path, f'{i}.{self.extension}')
+    
+    def get_blob_path(self, key):
+        
+        return os.path.join(self.blob_path, key[:2], f'{key}.{self.extension}')
+    
+    def add_blob(self, key, write):
+        """Returns the path of a blob. write(path) is called if the blob does not exist."""
+        
+        blob = self.get_blob_path(key)
+        if key not in self.keys:
+            self.keys.add(key)
+            if not os.path.exists(blob):
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                write(blob)
+        return blob
+    
+    def get_key(self, i):
+        """Returns the key of the frame i written by a previous conversion, or None"""
+        
+        path = self.get_path(i)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            key = get_content_key(f.read())
+        self.add_blob(key, lambda blob: link_or_copy(path, blob))
+        return key
+    
+    def put(self, i, key, data):
+        
+        def write(blob):
+            temp_file = blob + '.tmp'
+            with open(temp_file, 'wb') as f:
+                f.write(data)
+            os.replace(temp_file, blob)
+        
+        link_or_copy(self.add_blob(key, write), self.get_path(i))
+    
+    def put_file(self, i, key, file_path):
+        
+        link_or_copy(self.add_blob(key, lambda blob: link_or_copy(file_path, blob)), self.get_path(i))
+    
+    def put_same(self, i, key):
+        
+        link_or_copy(self.get_blob_path(key), self.get_path(i))
+    
+    def close(self):
+        """Removes frames and blobs left by a previous conversion"""
+        
+        remove_extra_frames(self.output_path, self.num_frames, self.extension)
+        
+        for dir_path, _, names in os.walk(self.blob_path, topdown=False):
+            for name in names:
+                key, ext = os.path.splitext(name)
+                if key not in self.keys or ext != '.' + self.extension:
+                    os.remove(os.path.join(dir_path, name))
+            if not os.listdir(dir_path):
+                os.rmdir(dir_path)
+
+
+# Manifest of a converted record
+# manifest.json has the signature of the input and the options.
+# A conversion with the same signature can reuse the frames already written.
+MANIFEST_FILE_NAME = 'manifest.json'
+MANIFEST_VERSION = 2
+BLOB_DIR_NAME = 'blobs'
+
+
+def get_input_signature(input_path, base_interval, link_frames=True, output_format='frames', export_actions=True,
+                        transform=None):
+    """Returns a dict that changes when the record or the options are changed.
+    Files are compared with their names, sizes and mtimes."""
+    
+    h = hashlib.sha1()
+    for name in sorted(os.listdir(input_path)):
+        st = os.stat(os.path.join(input_path, name))
+        h.update(f'{name}\t{st.st_size}\t{st.st_mtime_ns}\n'.encode('utf-8'))
+    
+    return {
+        'version': MANIFEST_VERSION,
+        'base_interval': base_interval,
+        'link_frames': link_frames,
+        'output_format': output_format,
+        'export_actions': export_actions,
+        'transform': (transform or FrameTransform()).get_description(),
+        'files': h.hexdigest(),
+    }
+
+
+def read_manifest(output_path):
+    
+    file_path = os.path.join(output_path, MANIFEST_FILE_NAME)
+    if not os.path.exists(file_path):
+        return None
+    try:
+        with open(file_path) as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+
+def write_json_atomically(file_path, data):
+    
+    temp_file = file_path + '.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump(data, f)
+    os.replace(temp_file, file_path)
+
+
+def is_up_to_date(input_path, output_path, base_interval, link_frames=True, output_format='frames', 
+                  export_actions=True, transform=None):
+    """Returns True if the output was completed from the same input and options"""
+    
+    signature = get_input_signature(
+        input_path, base_interval, link_frames, output_format, export_actions, transform)
+    manifest = read_manifest(output_path)
+    return (manifest is not None and manifest.get('complete', False)
+            and manifest.get('signature') == signature)
+
+
+def remove_extra_frames(output_path, num_frames, extension='jpeg'):
+    """Removes frames left by a previous conversion with more frames or another extension,
+    and temporary files"""
+    
+    re_frame = re.compile(r'([0-9]+)\.(jpeg|png|webp)(\.tmp)?')
+    for name in os.listdir(output_path):
+        m = re_frame.fullmatch(name)
+        if m and (int(m.group(1)) >= num_frames or m.group(2) != extension or m.group(3)):
+            os.remove(os.path.join(output_path, name))
+
+
+# Action arrays
+# actions.npy has the action of each interval (see README) in the fields of a fixed-width record.
+# X and Y are -1 if no xy is known. The other fields are 0 if no event occurred in the interval.
+#     KE: index in KEY_EVENT_TYPES
+#     KI: index in KEY_VOCABULARY, which is also written in keys.json
+#     BE: index in BUTTON_EVENT_TYPES
+#     BI: button id + 1
+ACTIONS_FILE_NAME = 'actions.npy'
+KEYS_FILE_NAME = 'keys.json'
+ACTION_DTYPE = np.dtype([
+    ('X', '<i2'), ('Y', '<i2'), ('KE', 'u1'), ('KI', '<u2'), ('BE', 'u1'), ('BI', 'u1'),
+])
+KEY_EVENT_TYPES = ('none', 'down', 'up')
+BUTTON_EVENT_TYPES = ('none', 'down', 'up') + RecordData.click_types
+
+
+def encode_action(interval):
+    """Returns the action of an interval as a tuple in the order of ACTION_DTYPE"""
+    
+    x, y = interval.xy or (-1, -1)
+    
+    key_event, key_id = 0, 0
+    if interval.key_event:
+        ev = interval.key_event
+        key_event = KEY_EVENT_TYPES.index('down' if ev.key_mask else 'up')
+        key_id = KEY_IDS.get(ev.physical_key, KEY_IDS['[Unknown]'])
+    
+    button_event, button_id = 0, 0
+    if interval.button_event:
+        ev = interval.button_event
+        button_event = BUTTON_EVENT_TYPES.index(ev.event_type)
+        button_id = ev.button_id + 1
+    
+    return (x, y, key_event, key_id, button_event, button_id)
+
+
+def write_actions(output_path, actions):
+    
+    file_path = os.path.join(output_path, ACTIONS_FILE_NAME)
+    temp_file = file_path + '.tmp'
+    with open(temp_file, 'wb') as f:
+        np.save(f, actions)
+    os.replace(temp_file, file_path)
+    
+    write_json_atomically(os.path.join(output_path, KEYS_FILE_NAME), KEY_VOCABULARY)
+
+
+def remove_actions(output_path):
+    
+    for name in (ACTIONS_FILE_NAME, KEYS_FILE_NAME):
+        file_path = os.path.join(output_path, name)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
+def load_actions(output_path):
+    """Loads the actions of a converted record as memory-mapped arrays aligned to the frames.
+    Returns a dict of xy (frames x 2), key_event, key_id, button_event and button_id.
+    The arrays are views of actions.npy, so nothing is read until they are indexed."""
+    
+    actions = np.load(os.path.join(output_path, ACTIONS_FILE_NAME), mmap_mode='r')
+    return {
+        'xy': numpy.lib.recfunctions.structured_to_unstructured(actions[['X', 'Y']]),
+        'key_event': actions['KE'],
+        'key_id': actions['KI'],
+        'button_event': actions['BE'],
+        'button_id': actions['BI'],
+    }
+
+
+OUTPUT_FORMATS = ('frames', 'shard')
+
+
+def serialize(input_path, output_path, base_interval, num_workers=None, link_frames=True, progress=None,
+              resume=False, max_pending=None, output_format='frames', export_actions=True, transform=None):
+    """Converts a record into frames and meta.json.
+    output_format is one of OUTPUT_FORMATS:
+        frames: a {i}.jpeg file per frame, a hardlink of a blob in the content-addressed store
+        shard: frames packed in shards with an index (see shard.py)
+    Frames with the same bytes are stored once, and the entries of meta.json have the keys of the frames.
+    With export_actions, the actions are also written in actions.npy (always in the shard format).
+    transform (FrameTransform) crops, resizes and converts the frames.
+    The intervals are read from RecordStream, so a long record is converted with bounded memory.
+    The cursor and xy of each frame are decided in the order of the intervals.
+    Then frames are composited and encoded by num_workers processes (cpu count if None).
+    At most max_pending frames (4 per worker if None) wait for the workers at a time.
+    With link_frames, frames are not encoded again if possible:
+        a frame without a cursor is stored from the source image if transform does nothing, and
+        a frame same as the previous frame is stored as the previous frame.
+    progress is called with (number of written frames, number of frames) if given.
+    With resume, frames already written by an unfinished conversion of the same input are kept.
+    Shards are always written from scratch.
+    """
+    
+    assert output_format in OUTPUT_FORMATS, f'unknown output format: {output_format}'
+    
+    stream = RecordStream(input_path, base_interval)
+    num_frames = len(stream)
     
     if not os.path.exists(output_path):
         os.mkdir(output_path)
     
-    metadata = []
+    export_actions = export_actions or output_format == 'shard'
+    if transform is None:
+        transform = FrameTransform()
+    signature = get_input_signature(
+        input_path, base_interval, link_frames, output_format, export_actions, transform)
+    manifest = read_manifest(output_path)
+    keep_frames = (resume and output_format == 'frames' 
+                   and manifest is not None and manifest.get('signature') == signature)
+    write_json_atomically(
+        os.path.join(output_path, MANIFEST_FILE_NAME), 
+        {'signature': signature, 'num_frames': num_frames, 'complete': False},
+    )
+    
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    if max_pending is None:
+        max_pending = 4 * num_workers
+    
+    counts = {
+        'done': 0,
+        'encoded': 0,
+        'linked': 0,
+        'duplicated': 0,
+    }
+    
+    if output_format == 'shard':
+        frames = shard.ShardWriter(output_path, num_frames)
+    else:
+        frames = FrameFiles(output_path, num_frames, transform.extension)
+    
+    actions = None
+    if export_actions:
+        actions = np.zeros(num_frames, dtype=ACTION_DTYPE)
+    
+    # meta.json is written entry by entry in the same form as json.dump of the list.
+    # An entry waits until the key of its frame is known.
+    metadat_path = os.path.join(output_path, 'meta.json')
+    meta_file = open(metadat_path + '.tmp', 'w')
+    meta_file.write('[')
+    entries = collections.deque()
+    frame_keys = {}
+    
+    def flush_entries():
+        while entries and entries[0]['idx'] in frame_keys:
+            entry = entries.popleft()
+            entry['frame'] = frame_keys.pop(entry['idx'])
+            if entry['idx'] > 0:
+                meta_file.write(', ')
+            meta_file.write(json.dumps(entry))
+    
+    def on_done(i, key):
+        frame_keys[i] = key
+        counts['done'] += 1
+        if progress:
+            progress(counts['done'], num_frames)
+    
+    # the key of the previous frame, or the job that the previous frame waits for
+    last = {
+        'key': None,
+        'job': None,
+    }
     
-    dummy_image = PIL.Image.new('RGB', record_data.image_size)
+    # frames waiting for the workers: (async result, frame index)
+    pending = collections.deque()
+    # frame waiting for a worker -> frames same as it
+    pending_links = {}
+    pool = None
+    
+    def put(i, data):
+        key = get_content_key(data)
+        frames.put(i, key, data)
+        on_done(i, key)
+        return key
+    
+    def finish_oldest():
+        result, i = pending.popleft()
+        key = put(i, result.get())
+        # the frame exists now
+        for j in pending_links.pop(i):
+            frames.put_same(j, key)
+            on_done(j, key)
+        if last['job'] == i:
+            last['key'], last['job'] = key, None
+    
+    def encode(i, job):
+        nonlocal pool
+        counts['encoded'] += 1
+        if num_workers <= 1:
+            last['key'], last['job'] = put(i, render_frame(job)), None
+            return
+        if pool is None:
+            # spawn because the web ui calls this from a thread
+            context = multiprocessing.get_context('spawn')
+            pool = context.Pool(num_workers, init_frame_worker, (stream.image_size, transform))
+        while len(pending) >= max_pending:
+            finish_oldest()
+        pending.append((pool.apply_async(render_frame, (job,)), i))
+        pending_links[i] = []
+        last['key'], last['job'] = None, i
+    
+    def duplicate(i):
+        counts['duplicated'] += 1
+        if last['job'] is not None:
+            pending_links[last['job']].append(i)
+        else:
+            frames.put_same(i, last['key'])
+            on_done(i, last['key'])
+    
+    init_frame_worker(stream.image_size, transform)
+    if progress:
+        progress(0, num_frames)
     
     status = {
         'cursor': None,
@@ -910,57 +2183,227 @@ def serialize(input_path, output_path, base_interval):
             elif ev.name == 'stop':
                 pass
     
-    for i, interval in enumerate(record_data.intervals):
-        
-        # make image with the last status
-        if interval.image is not None:
-            screen = interval.image.screen
-            if status['cursor'] and status['xy']:
-                screen = status['cursor'].draw(screen, status['xy']) 
-            input_image = screen
-        else:
-            input_image = dummy_image
-        input_image.save(os.path.join(output_path, f'{i}.jpeg'))
-        
-        # output based on the image currently shown in image_view
-        key_data = None
-        if interval.key_event:
-            ev = interval.key_event
-            key_data = {'physical_key':ev.physical_key, 'event': 'down' if ev.key_mask else 'up'}
-        
-        button_data = None
-        if interval.button_event:
-            ev = interval.button_event
-            button_data = {'button_id':ev.button_id, 'event':ev.event_type}
-        
-        control_data = None
-        if interval.control_events:
-            control_data = [str(ev) for ev in interval.control_events or []]
-        
-        metadata.append({
-            'idx': i,
-            'ge': interval.ge,
-            'lt': interval.lt,
-            'xy': interval.xy,
-            'key': key_data,
-            'button': button_data,
-            'control': control_data,
-        })
-        
-        if interval.control_events:
-            on_control_events(status, interval)
-    
-        if interval.cursor_event:
-            status['cursor'] = interval.cursor_event.cursor
-    
-        status['xy'] = interval.xy
+    last_frame = None
+    link_sources = transform.is_identity
     
-    metadat_path = os.path.join(output_path, 'meta.json')
-    json.dump(metadata, open(metadat_path, 'w'))
+    try:
+        for i, interval in enumerate(stream):
+            
+            # make image with the last status
+            image_path = None
+            cursor = None
+            if interval.image is not None:
+                image_path = interval.image.path
+                if status['cursor'] and status['xy']:
+                    cursor = status['cursor']
+            
+            # the holder itself is compared (by identity) and kept alive by last_frame
+            frame = (image_path, cursor, status['xy'] if cursor is not None else None)
+            job = (image_path, cursor.args if cursor is not None else None, status['xy'])
+            kept_key = frames.get_key(i) if keep_frames else None
+            if kept_key is not None:
+                on_done(i, kept_key)
+                last['key'], last['job'] = kept_key, None
+            elif not link_frames:
+                encode(i, job)
+            elif frame == last_frame:
+                duplicate(i)
+            elif image_path is not None and cursor is None and link_sources:
+                counts['linked'] += 1
+                with open(image_path, 'rb') as f:
+                    key = get_content_key(f.read())
+                frames.put_file(i, key, image_path)
+                on_done(i, key)
+                last['key'], last['job'] = key, None
+            else:
+                encode(i, job)
+            last_frame = frame
+            
+            # output based on the image currently shown in image_view
+            key_data = None
+            if interval.key_event:
+                ev = interval.key_event
+                key_data = {'physical_key':ev.physical_key, 'event': 'down' if ev.key_mask else 'up'}
+            
+            button_data = None
+            if interval.button_event:
+                ev = interval.button_event
+                button_data = {'button_id':ev.button_id, 'event':ev.event_type}
+            
+            control_data = None
+            if interval.control_events:
+                control_data = [str(ev) for ev in interval.control_events or []]
+            
+            if actions is not None:
+                actions[i] = encode_action(interval)
+            
+            entries.append({
+                'idx': i,
+                'frame': None,
+                'ge': interval.ge,
+                'lt': interval.lt,
+                'xy': interval.xy,
+                'key': key_data,
+                'button': button_data,
+                'control': control_data,
+            })
+            flush_entries()
+            
+            if interval.control_events:
+                on_control_events(status, interval)
+        
+            if interval.cursor_event:
+                status['cursor'] = interval.cursor_event.cursor
+        
+            status['xy'] = interval.xy
+        
+        while pending:
+            finish_oldest()
+        flush_entries()
+        
+        meta_file.write(']')
+    finally:
+        meta_file.close()
+        if pool is not None:
+            pool.terminate()
+    
+    dedup_ratio = num_frames / max(1, frames.num_blobs)
+    print(f'frames: encoded={counts["encoded"]}, linked={counts["linked"]}, duplicated={counts["duplicated"]}, '
+          f'blobs={frames.num_blobs}, dedup ratio={dedup_ratio:.2f}')
+    
+    os.replace(metadat_path + '.tmp', metadat_path)
+    
+    frames.close()
+    if output_format == 'shard':
+        remove_extra_frames(output_path, 0)
+        shutil.rmtree(os.path.join(output_path, BLOB_DIR_NAME), ignore_errors=True)
+    else:
+        shard.remove_shards(output_path)
+    
+    if actions is not None:
+        write_actions(output_path, actions)
+    else:
+        remove_actions(output_path)
+    write_json_atomically(
+        os.path.join(output_path, MANIFEST_FILE_NAME), 
+        {
+            'signature': signature, 
+            'num_frames': num_frames, 
+            'num_blobs': frames.num_blobs,
+            'dedup_ratio': dedup_ratio,
+            'complete': True,
+        },
+    )
+
+
+def convert_record(args):
+    """Converts a record for convert_records. Returns (name, state)."""
+    
+    (name, records_dir, converted_dir, base_interval, num_workers, force, output_format, export_actions, 
+     transform, link_frames) = args
+    
+    input_path = os.path.join(records_dir, name)
+    output_path = os.path.join(converted_dir, name)
+    
+    if not force and is_up_to_date(input_path, output_path, base_interval, link_frames=link_frames, 
+                                   output_format=output_format, export_actions=export_actions, 
+                                   transform=transform):
+        return name, 'skipped'
+    
+    try:
+        serialize(input_path, output_path, base_interval, num_workers=num_workers, link_frames=link_frames,
+                  resume=not force, output_format=output_format, export_actions=export_actions, 
+                  transform=transform)
+    except Exception as e:
+        print(f'{name}: conversion failed: {e}')
+        return name, 'failed'
+    return name, 'converted'
+
+
+def convert_records(records_dir, converted_dir, base_interval, num_jobs=None, names=None, force=False,
+                    output_format='frames', export_actions=True, transform=None, link_frames=True):
+    """Converts records under records_dir.
+    Records are converted by num_jobs processes in parallel, 
+    or by a process with parallel frame workers if only a record is converted.
+    Records converted from the same input are skipped unless force is True."""
+    
+    if names is None:
+        names = sorted(n for n in os.listdir(records_dir) 
+                       if os.path.isdir(os.path.join(records_dir, n)))
+    
+    if not os.path.exists(converted_dir):
+        os.makedirs(converted_dir)
+    
+    if num_jobs is None:
+        num_jobs = os.cpu_count() or 1
+    num_jobs = min(num_jobs, len(names))
+    
+    results = {}
+    if num_jobs <= 1:
+        for name in names:
+            name, state = convert_record(
+                (name, records_dir, converted_dir, base_interval, None, force, output_format, export_actions, 
+                 transform, link_frames))
+            print(f'{name}: {state}')
+            results[name] = state
+    else:
+        tasks = [(name, records_dir, converted_dir, base_interval, 1, force, output_format, export_actions, 
+                  transform, link_frames) for name in names]
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(num_jobs) as pool:
+            for name, state in pool.imap_unordered(convert_record, tasks):
+                print(f'{name}: {state}')
+                results[name] = state
+    
+    return results
 
 
 if __name__ == '__main__':
     
-    import sys
-    base_dir = sys.argv[1]
-    serialize(base_dir, None, base_interval=0.1)
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='Converts records into image-action sequences.')
+    parser.add_argument('names', nargs='*', help='names of records to convert (all records if not given)')
+    parser.add_argument('--records_dir', default='/files/records')
+    parser.add_argument('--converted_dir', default='/files/converted')
+    parser.add_argument('--base_interval', type=float, default=0.1)
+    parser.add_argument('--jobs', type=int, default=None, help='number of processes (cpu count if not given)')
+    parser.add_argument('--force', action='store_true', help='convert records again from scratch')
+    parser.add_argument('--output_format', choices=OUTPUT_FORMATS, default='frames',
+                        help='frames: a jpeg file per frame, shard: frames packed in shards with an index')
+    parser.add_argument('--no_actions', dest='export_actions', action='store_false',
+                        help='do not write actions.npy (always written in the shard format)')
+    parser.add_argument('--size', type=int, nargs=2, metavar=('WIDTH', 'HEIGHT'), default=None,
+                        help='size of the output frames')
+    parser.add_argument('--crop', type=int, nargs=4, metavar=('LEFT', 'UPPER', 'RIGHT', 'LOWER'), default=None,
+                        help='box of the screen to keep, applied before resizing')
+    parser.add_argument('--mode', choices=FrameTransform.modes, default='RGB')
+    parser.add_argument('--image_format', choices=sorted(FrameTransform.extensions), default='JPEG')
+    parser.add_argument('--quality', type=int, default=None, help='quality of JPEG and WEBP')
+    parser.add_argument('--no_link', dest='link_frames', action='store_false',
+                        help='encode every frame instead of linking the source images and duplicates')
+    args = parser.parse_args()
+    
+    transform = FrameTransform(
+        size=args.size, 
+        crop=args.crop, 
+        mode=args.mode, 
+        image_format=args.image_format, 
+        quality=args.quality,
+    )
+    
+    results = convert_records(
+        args.records_dir, 
+        args.converted_dir, 
+        args.base_interval, 
+        num_jobs=args.jobs, 
+        names=args.names or None, 
+        force=args.force,
+        output_format=args.output_format,
+        export_actions=args.export_actions,
+        transform=transform,
+        link_frames=args.link_frames,
+    )
+    
+    counts = collections.Counter(results.values())
+    print(', '.join(f'{k}={v}' for k, v in sorted(counts.items())))
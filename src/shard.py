@@ -0,0 +1,154 @@
+# coding: utf-8
+# Packed frames of a converted record for RecVNC
+#
+# In the shard format, frames are not written as {i}.jpeg files.
+#     frames-00000.bin, frames-00001.bin, ...: encoded frames (JPEG) concatenated
+#     frames.idx.npy: (shard, offset, length) of each frame, aligned to the frame index
+# A shard is closed and the next shard is started when it exceeds max_shard_size.
+# Frames are put with the keys of their bytes, and the index entries of the same key
+# point to the same bytes, which are written once.
+#
+# A data loader can mmap the shards and read a frame without opening a file per frame.
+#
+
+import io
+import os
+import re
+import mmap
+
+import numpy as np
+import PIL.Image
+
+
+SHARD_FILE_NAME = 'frames-{:05d}.bin'
+INDEX_FILE_NAME = 'frames.idx.npy'
+
+INDEX_DTYPE = np.dtype([('shard', '<u4'), ('offset', '<u8'), ('length', '<u4')])
+
+RE_SHARD = re.compile(r'frames-([0-9]+)\.bin')
+
+
+def remove_shards(output_path, first_shard=0):
+    """Removes the shards from first_shard and the index if no shard is left"""
+
+    for name in os.listdir(output_path):
+        m = RE_SHARD.fullmatch(name)
+        if m and int(m.group(1)) >= first_shard:
+            os.remove(os.path.join(output_path, name))
+
+    index_path = os.path.join(output_path, INDEX_FILE_NAME)
+    if first_shard == 0 and os.path.exists(index_path):
+        os.remove(index_path)
+
+
+class ShardWriter(object):
+    """Writes the frames of a converted record into shards.
+    Frames can be put in any order; the index keeps their positions."""
+
+    def __init__(self, output_path, num_frames, max_shard_size=1 << 30):
+
+        self.output_path = output_path
+        self.max_shard_size = max_shard_size
+        self.index = np.zeros(num_frames, dtype=INDEX_DTYPE)
+        # key -> index entry of the bytes
+        self.entries = {}
+        self.shard_id = -1
+        self.file = None
+        self.size = 0
+
+    def open_next(self):
+
+        if self.file is not None:
+            self.file.close()
+        self.shard_id += 1
+        self.file = open(os.path.join(self.output_path, SHARD_FILE_NAME.format(self.shard_id)), 'wb')
+        self.size = 0
+
+    @property
+    def num_blobs(self):
+
+        return len(self.entries)
+
+    def put(self, i, key, data):
+        """Appends the bytes of the frame i unless the bytes of the key have been written"""
+
+        if key in self.entries:
+            self.index[i] = self.entries[key]
+            return
+
+        if self.file is None or (self.size > 0 and self.size + len(data) > self.max_shard_size):
+            self.open_next()
+
+        self.entries[key] = (self.shard_id, self.size, len(data))
+        self.index[i] = self.entries[key]
+        self.file.write(data)
+        self.size += len(data)
+
+    def put_file(self, i, key, file_path):
+        """Appends an encoded image file as the frame i"""
+
+        if key in self.entries:
+            self.index[i] = self.entries[key]
+            return
+
+        with open(file_path, 'rb') as f:
+            self.put(i, key, f.read())
+
+    def put_same(self, i, key):
+        """Makes the frame i share the bytes of the key, which have been put"""
+
+        self.index[i] = self.entries[key]
+
+    def close(self):
+        """Writes the index and removes shards left by a previous conversion"""
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+        index_path = os.path.join(self.output_path, INDEX_FILE_NAME)
+        temp_file = index_path + '.tmp'
+        with open(temp_file, 'wb') as f:
+            np.save(f, self.index)
+        os.replace(temp_file, index_path)
+
+        remove_shards(self.output_path, self.shard_id + 1)
+
+
+class ShardReader(object):
+    """Random access to the frames of a converted record in the shard format"""
+
+    def __init__(self, path):
+
+        self.path = path
+        self.index = np.load(os.path.join(path, INDEX_FILE_NAME), mmap_mode='r')
+        self.shards = {}
+
+    def __len__(self):
+
+        return len(self.index)
+
+    def get_shard(self, shard_id):
+
+        shard = self.shards.get(shard_id)
+        if shard is None:
+            with open(os.path.join(self.path, SHARD_FILE_NAME.format(shard_id)), 'rb') as f:
+                shard = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.shards[shard_id] = shard
+        return shard
+
+    def __getitem__(self, i):
+        """Returns the encoded bytes of the frame i"""
+
+        shard_id, offset, length = self.index[i].tolist()
+        return self.get_shard(shard_id)[offset:offset+length]
+
+    def open_image(self, i):
+
+        return PIL.Image.open(io.BytesIO(self[i]))
+
+    def close(self):
+
+        for shard in self.shards.values():
+            shard.close()
+        self.shards = {}
@@ -7,8 +7,55 @@ from vncdotool_mini import rfb
 
 import sys
 import time
-import json
-import base64
+from struct import pack
+
+import eventlog
+
+
+# Encodings of which the rectangles are decoded into the framebuffer.
+# While the framebuffer is kept, the other encodings are removed from SetEncodings of the viewer
+# because their rectangles are skipped (ZLIB) or desynchronize the parser (e.g. Tight).
+DECODED_ENCODINGS = (
+    rfb.RAW_ENCODING,
+    rfb.COPY_RECTANGLE_ENCODING,
+    rfb.RRE_ENCODING,
+    rfb.CORRE_ENCODING,
+    rfb.HEXTILE_ENCODING,
+    rfb.ZRLE_ENCODING,
+    rfb.PSEUDO_CURSOR_ENCODING,
+    rfb.PSEUDO_DESKTOP_SIZE_ENCODING,
+)
+
+# pseudo encodings that only give hints to the server and never come as rectangles:
+# JPEG quality levels and compression levels
+HINT_ENCODINGS = (range(-32, -22), range(-256, -246))
+
+
+def filter_encodings(encodings):
+    """Returns the encodings that the framebuffer can follow, in the order of preference"""
+    
+    return [e for e in encodings 
+            if e in DECODED_ENCODINGS or any(e in r for r in HINT_ENCODINGS)]
+
+
+class PrintWriter(object):
+    """Prints events instead of writing them. Used when this script runs alone."""
+    
+    running = True
+    
+    def push(self, event, args, t=None):
+        
+        print(time.time() if t is None else t, event, args)
+    
+    def set_default(self, name, data):
+        
+        print('default', name, data)
+    
+    def add_cursor(self, args):
+        
+        key = eventlog.cursor_key(*args)
+        print('cursor', key, args[:4])
+        return key
 
 
 class NullTransport(object):
@@ -25,6 +72,110 @@ class NullTransport(object):
         return
 
 
+class Framebuffer(object):
+    """Holds the pixels of the remote screen.
+    The buffer is updated with the rectangles decoded from the proxied stream.
+    
+    The buffer is a list of rows. A frame taken by get_frame() shares the rows,
+    and a shared row is copied when it is written next.
+    Taking a frame does not copy the whole buffer on the reactor thread."""
+    
+    @staticmethod
+    def get_rawmode(bpp, bigendian, truecolor, redshift, greenshift, blueshift):
+        """Returns the raw mode for PIL of a pixel format or None if not supported"""
+        
+        if bpp != 32 or not truecolor:
+            return None
+        
+        channels = ['X'] * 4
+        for c, shift in (('R', redshift), ('G', greenshift), ('B', blueshift)):
+            if shift % 8 != 0:
+                return None
+            i = shift // 8
+            channels[3 - i if bigendian else i] = c
+        
+        rawmode = ''.join(channels)
+        if rawmode not in ('RGBX', 'BGRX', 'XRGB', 'XBGR'):
+            return None
+        return rawmode
+    
+    def __init__(self, width, height, bypp=4):
+        
+        self.rawmode = None
+        # False after a rectangle that is not decoded; the pixels are unknown
+        self.valid = True
+        self.resize(width, height, bypp)
+    
+    def resize(self, width, height, bypp=None):
+        
+        self.width = width
+        self.height = height
+        self.bypp = bypp or self.bypp
+        self.stride = width * self.bypp
+        self.rows = [bytearray(self.stride) for _ in range(height)]
+        # a row is written in place if it has been copied since the last frame was taken
+        self.generation = 0
+        self.row_generations = [0] * height
+    
+    def get_row(self, r):
+        """Returns the row r to be written"""
+        
+        if self.row_generations[r] != self.generation:
+            self.rows[r] = bytearray(self.rows[r])
+            self.row_generations[r] = self.generation
+        return self.rows[r]
+    
+    def set_pixel_format(self, bpp, bigendian, truecolor, redshift, greenshift, blueshift):
+        
+        if bpp // 8 != self.bypp:
+            self.resize(self.width, self.height, bpp // 8)
+        self.rawmode = self.get_rawmode(bpp, bigendian, truecolor, redshift, greenshift, blueshift)
+    
+    def clip(self, x, y, width, height):
+        
+        return min(width, self.width - x), min(height, self.height - y)
+    
+    def update_rectangle(self, x, y, width, height, data):
+        
+        row = width * self.bypp
+        w, h = self.clip(x, y, width, height)
+        n = w * self.bypp
+        o = x * self.bypp
+        for r in range(h):
+            self.get_row(y + r)[o:o+n] = data[r*row:r*row+n]
+    
+    def copy_rectangle(self, srcx, srcy, x, y, width, height):
+        
+        w, h = self.clip(x, y, width, height)
+        w, h = min(w, self.width - srcx), min(h, self.height - srcy)
+        n = w * self.bypp
+        # rows are copied before writing because the areas may overlap
+        o = srcx * self.bypp
+        rows = [self.rows[srcy + r][o:o+n] for r in range(h)]
+        o = x * self.bypp
+        for r, row in enumerate(rows):
+            self.get_row(y + r)[o:o+n] = row
+    
+    def fill_rectangle(self, x, y, width, height, color):
+        
+        w, h = self.clip(x, y, width, height)
+        row = bytes(color[:self.bypp]) * w
+        n = len(row)
+        o = x * self.bypp
+        for r in range(h):
+            self.get_row(y + r)[o:o+n] = row
+    
+    def get_frame(self):
+        """Returns size, the rows of the buffer and the raw mode.
+        The rows are not written after this; join them to get the pixels.
+        None will be returned if the pixel format is not supported or the pixels are unknown."""
+        
+        if self.rawmode is None or not self.valid:
+            return None
+        self.generation += 1
+        return (self.width, self.height), tuple(self.rows), self.rawmode
+
+
 class DummyRFBClient(rfb.RFBClient):
     
     def __init__(self, transport, peer_proxy, factory):
@@ -38,6 +189,14 @@ class DummyRFBClient(rfb.RFBClient):
         
         self.cursor = None
         self.cmask = None
+        
+        # frame capture from the framebuffer updates
+        self.frame_stream = factory.frame_stream
+        self.framebuffer = None
+        self.has_frame = False
+        self.t_commit = None
+        self.t_last_push = -float('inf')
+        self.pending_push = None
     
     def vncRequestPassword(self):
         
@@ -45,25 +204,115 @@ class DummyRFBClient(rfb.RFBClient):
     
     def vncConnectionMade(self):
         
-        pass
+        if self.frame_stream is not None and self.frame_stream.enabled:
+            self.framebuffer = Framebuffer(self.width, self.height, self.bypp)
+            self.framebuffer.set_pixel_format(
+                self.bpp, self.bigendian, self.truecolor, 
+                self.redshift, self.greenshift, self.blueshift)
+            self.frame_stream.set_source(self.get_frame)
+    
+    def set_pixel_format(self, bpp, depth, bigendian, truecolor, 
+                         redmax, greenmax, bluemax, redshift, greenshift, blueshift):
+        """The viewer decides the pixel format of the following updates.
+        DummyRFBServer reports it through this method."""
+        
+        self.bpp, self.depth, self.bigendian, self.truecolor = bpp, depth, bigendian, truecolor
+        self.redmax, self.greenmax, self.bluemax = redmax, greenmax, bluemax
+        self.redshift, self.greenshift, self.blueshift = redshift, greenshift, blueshift
+        self.bypp = self.bpp // 8
+        
+        if self.framebuffer is not None:
+            self.framebuffer.set_pixel_format(bpp, bigendian, truecolor, redshift, greenshift, blueshift)
+            self.has_frame = False
+    
+    def updateRectangle(self, x, y, width, height, data):
+        
+        if self.framebuffer is not None:
+            self.framebuffer.update_rectangle(x, y, width, height, data)
+    
+    def copyRectangle(self, srcx, srcy, x, y, width, height):
+        
+        if self.framebuffer is not None:
+            self.framebuffer.copy_rectangle(srcx, srcy, x, y, width, height)
+    
+    def fillRectangle(self, x, y, width, height, color):
+        
+        if self.framebuffer is not None:
+            self.framebuffer.fill_rectangle(x, y, width, height, color)
+    
+    def updateDesktopSize(self, width, height):
+        
+        self.width = width
+        self.height = height
+        if self.framebuffer is not None:
+            self.framebuffer.resize(width, height)
+            self.has_frame = False
+    
+    def undecodedRectangle(self, x, y, width, height, encoding):
+        
+        if self.framebuffer is not None and self.framebuffer.valid:
+            print('frames are not captured from the framebuffer any more: '
+                  'a rectangle in encoding {} is not decoded'.format(encoding))
+            self.framebuffer.valid = False
+    
+    def commitUpdate(self, rectangles=None):
+        
+        if self.framebuffer is None:
+            return
+        
+        self.has_frame = True
+        self.t_commit = (time.time(), time.monotonic())
+        
+        if not self.frame_stream.active:
+            return
+        
+        # Frames are pushed at most once in min_interval.
+        # Updates committed in the meantime are pushed together later.
+        if self.pending_push is None:
+            wait = self.t_last_push + self.frame_stream.min_interval - self.t_commit[1]
+            if wait <= 0:
+                self.push_frame()
+            else:
+                self.pending_push = reactor.callLater(wait, self.push_frame)
+    
+    def push_frame(self):
+        
+        self.pending_push = None
+        self.t_last_push = time.monotonic()
+        frame = self.get_frame()
+        if frame is not None:
+            self.frame_stream.push(*frame)
+    
+    def get_frame(self):
+        """Returns the last committed frame with its timestamps"""
+        
+        if self.framebuffer is None or not self.has_frame:
+            return None
+        frame = self.framebuffer.get_frame()
+        if frame is None:
+            return None
+        return (*self.t_commit, *frame)
+    
+    def connectionLost(self, reason):
+        
+        super().connectionLost(reason)
+        if self.pending_push is not None and self.pending_push.active():
+            self.pending_push.cancel()
+        self.pending_push = None
+        if self.frame_stream is not None and self.frame_stream.snapshot_func == self.get_frame:
+            self.frame_stream.set_source(None)
     
     def updateCursor(self, x, y, width, height, image, mask):
     
         if self.factory.nocursor:
             return
         
-        str_image = base64.b64encode(image).decode('utf-8')
-        str_mask = base64.b64encode(mask).decode('utf-8')
-        
+        # events refer to the cursor table with the key
+        key = self.writer.add_cursor([x, y, width, height, image, mask])
+        data = [key]
         if self.writer.running:
-            data = {
-                'time': time.time(),
-                'event': 'cursor',
-                'args': [x, y, width, height, str_image, str_mask],
-            }
-            self.writer(json.dumps(data))
+            self.writer.push('cursor', data)
         else:
-            data = [x, y, width, height, str_image, str_mask]
             self.writer.set_default('cursor', data)
     
     def _handleInitial(self):
@@ -157,24 +406,64 @@ class DummyRFBServer(rfb.RFBServer):
         self.writer = factory.writer
         self.buttons = 0
         self.mouse = (None, None)
+        
+        # While the framebuffer is kept, messages of the viewer are parsed before they are forwarded
+        # so that SetEncodings can be replaced. This starts with the normal protocol messages.
+        # The framebuffer is kept for the sessions connected while the frame stream is enabled.
+        self.rewrite_encodings = factory.frame_stream is not None and factory.frame_stream.enabled
+        self.filtering = False
+        self.replacement = None
+    
+    def filter(self, data):
+        """Parses the data from the viewer and returns the bytes to forward to the server.
+        While filtering, an incomplete message is held until the rest arrives."""
+        
+        if not self.filtering:
+            self.dataReceived(data)
+            if not self.buffer and self._handler[0] == self._handle_protocol:
+                self.filtering = True
+            return data
+        
+        self.buffer += data
+        forwarded = []
+        while len(self.buffer) >= self._handler[1]:
+            buffer, handler = self.buffer, self._handler
+            self.replacement = None
+            handler[0]()
+            n = len(buffer) - len(self.buffer)
+            if n > 0:
+                forwarded.append(buffer[:n] if self.replacement is None else self.replacement)
+            elif self._handler == handler:
+                # waiting for the rest of the message
+                break
+        return b''.join(forwarded)
+    
+    def handle_setEncodings(self, encodings):
+        
+        if not self.filtering:
+            return
+        
+        decoded = filter_encodings(encodings)
+        if len(decoded) != len(encodings):
+            print('encodings not decoded by the proxy are removed:', 
+                  sorted(set(encodings) - set(decoded)))
+            self.replacement = pack('!BxH', 2, len(decoded)) + pack('!' + 'i' * len(decoded), *decoded)
     
     def handle_keyEvent(self, key, down):
 
-        data = {
-            'time': time.time(),
-            'event': 'key',
-            'args': [key, down]
-        }
-        self.writer(json.dumps(data))
+        self.writer.push('key', [key, down])
     
     def handle_pointerEvent(self, x, y, buttonmask):
 
-        data = {
-            'time': time.time(),
-            'event': 'pointer',
-            'args': [x, y, buttonmask]
-        }
-        self.writer(json.dumps(data))
+        self.writer.push('pointer', [x, y, buttonmask])
+    
+    def handle_setPixelFormat(self, bpp, depth, bigendian, truecolor, 
+                              rmax, gmax, bmax, rshift, gshift, bshift):
+        
+        client = getattr(self.proxy.peer, 'internal_protocol', None)
+        if client is not None:
+            client.set_pixel_format(bpp, depth, bigendian, truecolor, 
+                                    rmax, gmax, bmax, rshift, gshift, bshift)
     
     def _handle_version(self):
         
@@ -265,6 +554,12 @@ class CustomVNCLoggingServerProxy(portforward.ProxyServer):
     
     def dataReceived(self, data):
         
+        if self.internal_protocol and self.internal_protocol.rewrite_encodings:
+            data = self.internal_protocol.filter(data)
+            if data:
+                super().dataReceived(data)
+            return
+        
         super().dataReceived(data)
         if self.internal_protocol:
             self.internal_protocol.dataReceived(data)
@@ -286,6 +581,7 @@ class CustomVNCLoggingServerFactory(portforward.ProxyFactory):
         password_required=False,
         pseudodesktop=False,
         writer=None,
+        frame_stream=None,
         **kwargs):
         
         super().__init__(*args, **kwargs)
@@ -296,6 +592,7 @@ class CustomVNCLoggingServerFactory(portforward.ProxyFactory):
         self.password_required = password_required
         self.pseudodesktop = pseudodesktop
         self.writer = writer
+        self.frame_stream = frame_stream
         self.listen_port = None
         self.time_connection_lost = {}
         self.connection_lost_schedule = {}
@@ -312,7 +609,7 @@ if __name__ == '__main__':
         host='localhost', 
         port=5900,
         password_required=True,
-        writer=print,
+        writer=PrintWriter(),
         pseudocursor=True,
     )
     factory.listen_tcp(5902)
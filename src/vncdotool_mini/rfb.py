@@ -498,6 +498,7 @@ class RFBClient(Protocol):
             else:
                 print("unknown encoding received (encoding %d)" % encoding)
                 log.msg("unknown encoding received (encoding %d)" % encoding)
+                self.undecodedRectangle(x, y, width, height, encoding)
                 self._doConnection()
         else:
             self._doConnection()
@@ -678,6 +679,7 @@ class RFBClient(Protocol):
         self.expect(self._handleDecodeZLIBdata, compressed_bytes, x, y, width, height)
     
     def _handleDecodeZLIBdata(self, block, x, y, width, height):
+        self.undecodedRectangle(x, y, width, height, ZLIB_ENCODING)
         self._doConnection()
     
     # ---  ZRLE Encoding
@@ -947,6 +949,10 @@ class RFBClient(Protocol):
     def updateDesktopSize(self, width, height):
         """ New desktop size of width*height. """
 
+    def undecodedRectangle(self, x, y, width, height, encoding):
+        """ A rectangle in an encoding that is skipped without decoding.
+            The pixels of the area are unknown after this. """
+
     def bell(self):
         """bell"""
 
@@ -1042,11 +1048,22 @@ class RFBServer(Protocol):
 
     def _handle_protocol(self):
         ptype = unpack('!B', self.buffer[0:1])[0]
-        nbytes = TYPE_LEN.get(ptype, 0)
+        if ptype not in TYPE_LEN:
+            # the length of an unknown message is unknown, so the stream cannot be parsed any more
+            log.msg("unknown message received (type %d)" % ptype)
+            self._handler = self._handle_unparsable, 1
+            self._handle_unparsable()
+            return
+        
+        nbytes = TYPE_LEN[ptype]
+        if ptype == 2 and len(self.buffer) >= nbytes:
+            # SetEncodings is followed by the list of encodings
+            nbytes += 4 * unpack('!xH', self.buffer[1:nbytes])[0]
         if len(self.buffer) < nbytes:
-            self._handler = self._handle_protocol, nbytes + 1
+            self._handler = self._handle_protocol, nbytes
             return
 
+        self._handler = self._handle_protocol, 1
         block = self.buffer[1:nbytes]
         self.buffer = self.buffer[nbytes:]
         
@@ -1054,10 +1071,8 @@ class RFBServer(Protocol):
             args = unpack('!xxxBBBBHHHBBBxxx', block)
             self.handle_setPixelFormat(*args)
         elif ptype == 2:
-            nencodings = unpack('!xH', block)[0]
-            nbytes = 4 * nencodings
-            encodings = unpack('!' + 'I' * nencodings, self.buffer[:nbytes])
-            self.buffer = self.buffer[nbytes:]
+            nencodings = unpack('!xH', block[:3])[0]
+            encodings = unpack('!' + 'i' * nencodings, block[3:])
             self.handle_setEncodings(encodings)
         elif ptype == 3:
             inc, x, y, w, h = unpack('!BHHHH', block)
@@ -1074,6 +1089,9 @@ class RFBServer(Protocol):
             self._handler = self._handle_client_cut_text, length
             return
     
+    def _handle_unparsable(self):
+        self.buffer = b''
+
     def _handle_client_cut_text(self):
         text = self.buffer[:self.expected_text_length]
         self.buffer = self.buffer[self.expected_text_length:]
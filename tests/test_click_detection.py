@@ -0,0 +1,216 @@
+# coding: utf-8
+# Button event detection of the serializer
+#
+# RecordData.obtain_click_up_down_events (bit operations over the button mask column)
+# and ButtonEventDetector (pointer events one by one, used by RecordStream)
+# are compared with the loop over events that they replaced.
+#
+#     python -m pytest tests
+#
+
+import os
+import sys
+import random
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from serializer import RecordData, PointerEvent, ButtonEvent, EventColumns, ButtonEventDetector
+
+
+TIME_ORIGIN_ABS = 1000.0
+UNIFICATION_INTERVALS = (None, 1/3)
+
+
+def reference_events(pointer_events, unification_interval=None):
+    """The loop over events that obtain_click_up_down_events replaced"""
+
+    time_abs = pointer_events.time_abs.tolist()
+    time_rel = pointer_events.time_rel.tolist()
+    xs = pointer_events.x.tolist()
+    ys = pointer_events.y.tolist()
+    button_masks = pointer_events.button_mask.tolist()
+    time_origin_abs = pointer_events.time_origin_abs
+
+    make_event = lambda i, bid, event_type: {
+        'time_rel': time_rel[i],
+        'obj': ButtonEvent(time_abs[i], time_origin_abs, [xs[i], ys[i], bid, event_type]),
+    }
+
+    if unification_interval is not None:
+        is_continuous = lambda i1, i2: abs(time_rel[i2] - time_rel[i1]) <= unification_interval
+    else:
+        is_continuous = lambda i1, i2: True
+
+    button_events = [[] for _ in range(RecordData.num_buttons)]
+    waiting_decision = [False] * RecordData.num_buttons
+
+    if len(pointer_events) == 0:
+        if unification_interval is not None:
+            return []
+        return button_events
+
+    last_ev = 0
+    last_masks = RecordData.split_masks(button_masks[0])
+
+    for ev in range(1, len(pointer_events)):
+
+        masks = RecordData.split_masks(button_masks[ev])
+
+        for bid, (l, lm) in enumerate(zip(masks, last_masks)):
+            if l != lm:
+                if l:
+                    # changed to down
+                    waiting_decision[bid] = True
+                else:
+                    # changed to up
+                    if waiting_decision[bid]:
+                        if is_continuous(last_ev, ev):
+                            button_events[bid].append(make_event(last_ev, bid, 'click'))
+                        else:
+                            button_events[bid].append(make_event(last_ev, bid, 'down'))
+                            button_events[bid].append(make_event(ev, bid, 'up'))
+                    else:
+                        button_events[bid].append(make_event(ev, bid, 'up'))
+                    waiting_decision[bid] = False
+            else:
+                if l and waiting_decision[bid]:
+                    # keeping down
+                    button_events[bid].append(make_event(last_ev, bid, 'down'))
+                waiting_decision[bid] = False
+
+        last_ev = ev
+        last_masks = masks
+
+    if unification_interval is not None:
+        return reference_unify_clicks(button_events, unification_interval)
+    return button_events
+
+
+def reference_unify_clicks(event_list, interval):
+    """The loop that unify_clicks replaced. This breaks the lists in event_list."""
+
+    is_continuous_click = lambda ev, next_ev: \
+        (next_ev is not None) and \
+        (abs(next_ev['time_rel'] - ev['time_rel']) <= interval) and \
+        (next_ev['obj'].event_type == 'click')
+
+    unified_event_list = []
+
+    for bid, _list in enumerate(event_list):
+        _list.append(None)
+        ev = _list.pop(0)
+        while ev is not None:
+            if ev['obj'].event_type == 'click':
+                for event_type in RecordData.click_types:
+                    next_ev = _list.pop(0)
+                    if not is_continuous_click(ev, next_ev):
+                        break
+                unified_event_list.append({
+                    'time_rel': ev['time_rel'],
+                    'obj': ButtonEvent(
+                        ev['obj'].time_abs, ev['obj'].time_origin_abs,
+                        [ev['obj'].x, ev['obj'].y, bid, event_type]),
+                })
+                ev = next_ev
+            else:
+                unified_event_list.append(ev)
+                ev = _list.pop(0)
+
+    return unified_event_list
+
+
+def make_pointer_events(seed, n=300):
+    """Pointer events of random buttons at random intervals around the unification interval"""
+
+    rnd = random.Random(seed)
+    t = TIME_ORIGIN_ABS
+    mask = 0
+    times, args = [], []
+    while len(times) < n:
+        if mask == 0 and rnd.random() < 0.1:
+            # quick clicks to be unified
+            bit = rnd.choice([1, 2, 4])
+            for _ in range(rnd.randint(1, 4)):
+                for m in (bit, 0):
+                    t += rnd.uniform(0.01, 0.12)
+                    times.append(t)
+                    args.append([rnd.randint(0, 799), rnd.randint(0, 599), m])
+            continue
+        t += rnd.choice([0.01, 0.1, 0.2, 0.3, 0.5, 1.0]) * rnd.random() * 2
+        if rnd.random() < 0.4:
+            mask ^= rnd.choice([1, 1, 1, 2, 4, 8, 16])
+        times.append(t)
+        args.append([rnd.randint(0, 799), rnd.randint(0, 599), mask])
+    return EventColumns(PointerEvent, times, TIME_ORIGIN_ABS, args)
+
+
+def make_key(ev):
+
+    return (ev['time_rel'], ev['obj'].time_abs, ev['obj'].time_origin_abs, tuple(ev['obj'].args))
+
+
+def flatten(result, unification_interval):
+
+    if unification_interval is None:
+        return [ev for _list in result for ev in _list]
+    return result
+
+
+def detect_one_by_one(pointer_events, unification_interval):
+    """Events of ButtonEventDetector in the order of RecordData (grouped by button)"""
+
+    detector = ButtonEventDetector(TIME_ORIGIN_ABS, unification_interval)
+    outputs = []
+    for t, x, y, button_mask in zip(
+            pointer_events.time_abs.tolist(), pointer_events.x.tolist(),
+            pointer_events.y.tolist(), pointer_events.button_mask.tolist()):
+        outputs += detector.push(t, x, y, button_mask)
+    outputs += detector.close()
+
+    button_events = [[] for _ in range(RecordData.num_buttons)]
+    for bid, ev in outputs:
+        button_events[bid].append(ev)
+    return [ev for _list in button_events for ev in _list]
+
+
+@pytest.mark.parametrize('unification_interval', UNIFICATION_INTERVALS)
+@pytest.mark.parametrize('seed', range(50))
+def test_vectorized_detection(seed, unification_interval):
+
+    pointer_events = make_pointer_events(seed)
+    result = RecordData.obtain_click_up_down_events(pointer_events, unification_interval)
+    reference = reference_events(pointer_events, unification_interval)
+    assert [make_key(ev) for ev in flatten(result, unification_interval)] == \
+        [make_key(ev) for ev in flatten(reference, unification_interval)]
+
+
+@pytest.mark.parametrize('unification_interval', UNIFICATION_INTERVALS)
+@pytest.mark.parametrize('seed', range(50))
+def test_detector(seed, unification_interval):
+
+    pointer_events = make_pointer_events(seed)
+    result = detect_one_by_one(pointer_events, unification_interval)
+    reference = reference_events(pointer_events, unification_interval)
+    assert [make_key(ev) for ev in result] == \
+        [make_key(ev) for ev in flatten(reference, unification_interval)]
+
+
+@pytest.mark.parametrize('unification_interval', UNIFICATION_INTERVALS)
+def test_no_pointer_events(unification_interval):
+
+    pointer_events = EventColumns(PointerEvent, [], TIME_ORIGIN_ABS, [])
+    result = RecordData.obtain_click_up_down_events(pointer_events, unification_interval)
+    assert flatten(result, unification_interval) == []
+    assert detect_one_by_one(pointer_events, unification_interval) == []
+
+
+def test_down_without_following_pointer_event():
+    """A down is decided only by the next pointer event, even if the time passes"""
+
+    detector = ButtonEventDetector(TIME_ORIGIN_ABS, 1/3)
+    assert detector.push(TIME_ORIGIN_ABS + 1.0, 10, 10, 0) == []
+    assert detector.push(TIME_ORIGIN_ABS + 2.0, 10, 10, 1) == []
+    assert detector.tick(TIME_ORIGIN_ABS + 5.0) == []
+    assert detector.close() == []